@@ -1,9 +1,11 @@
 from aiogram import Bot, Dispatcher
 
 from config import API_TOKEN
+from rate_limiter import RateLimitMiddleware
 
 
 # Инициализация бота и диспетчера в отдельном модуле
 bot = Bot(token=API_TOKEN)
+bot.session.middleware(RateLimitMiddleware())  # темп запросов и 429 (retry_after)
 dp = Dispatcher()
 
@@ -12,7 +12,15 @@ except ImportError:
     # Python 3.8 backport
     from backports.zoneinfo import ZoneInfo
 
+import endpoint_health
+import history
+import http_pool
+import loop_monitor
+import media_cache
+import metrics
 import stats
+import ytdlp_client
+from utils import flush_all_deletes
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -41,7 +49,7 @@ async def scheduled_stats_task():
             if now.weekday() == 6 and now.hour == 20 and now.minute == 0:
                 chat_id = stats.get_report_chat_id()
                 if chat_id:
-                    report = stats.get_stats_report()
+                    report = stats.get_window_report("За неделю", 7 * 24 * 3600) + "\n" + stats.get_stats_report()
                     await bot.send_message(chat_id, "📅 <b>Еженедельный отчет:</b>\n\n" + report, parse_mode="HTML")
                     logger.info(f"Weekly report sent to {chat_id}")
                     # Wait 61 seconds to avoid double sending
@@ -56,6 +64,12 @@ async def scheduled_stats_task():
 async def main() -> None:
     try:
         await bot.delete_webhook(drop_pending_updates=True)
+        await http_pool.startup()
+        endpoint_health.load()
+        media_cache.load()
+        await ytdlp_client.startup()
+        await metrics.startup()
+        loop_monitor.start()
         # Запускаем планировщик
         asyncio.create_task(scheduled_stats_task())
         
@@ -66,6 +80,15 @@ async def main() -> None:
     except Exception as e:
         logger.error("💥 Fatal: %s", e)
     finally:
+        loop_monitor.stop()
+        await flush_all_deletes()
+        await metrics.shutdown()
+        await http_pool.shutdown()
+        endpoint_health.save()
+        media_cache.save()
+        ytdlp_client.shutdown()
+        stats.close()
+        history.close()
         try:
             await bot.session.close()
         except Exception:
@@ -27,3 +27,107 @@ INSTAGRAM_APIS = [
     "https://storysaver.net/api?url=",
 ]
 
+
+# Общий пул HTTP-соединений (http_pool.py)
+# Группы хостов: у каждой своя сессия, свой лимит соединений и таймаут запроса
+HTTP_HOST_GROUPS = {
+    'tiktok': {'limit_per_host': 8, 'timeout': 25},     # tikwm.com и прочие TikTok API
+    'instagram': {'limit_per_host': 8, 'timeout': 35},  # Instagram API / HTML / GraphQL
+    'media': {'limit_per_host': 16, 'timeout': 120},    # прямые ссылки на файлы (CDN)
+}
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))       # всего соединений на группу
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))  # секунды
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+
+# Гонка TikTok API (downloaders.race_tiktok_apis)
+TIKTOK_RACE_WIDTH = int(os.getenv("TIKTOK_RACE_WIDTH", "3"))                # запросов одновременно
+TIKTOK_HEDGE_DELAY = float(os.getenv("TIKTOK_HEDGE_DELAY", "0.4"))          # пауза перед следующим API, с
+TIKTOK_SLIDESHOW_GRACE = float(os.getenv("TIKTOK_SLIDESHOW_GRACE", "1.0"))  # ждём слайдшоу после видео, с
+
+# Здоровье API-endpoint'ов (endpoint_health.py)
+ENDPOINT_HEALTH_FILE = os.getenv("ENDPOINT_HEALTH_FILE", "endpoint_health.json")
+ENDPOINT_EWMA_ALPHA = 0.3             # вес нового замера в EWMA
+ENDPOINT_DEFAULT_LATENCY = 2.0        # оценка латентности для нового endpoint'а, с
+BREAKER_FAILURE_THRESHOLD = 3         # ошибок подряд → circuit breaker открыт
+BREAKER_COOLDOWN = 300                # через сколько секунд пробуем открытый endpoint снова
+
+# Кэш Telegram file_id (media_cache.py)
+MEDIA_CACHE_FILE = os.getenv("MEDIA_CACHE_FILE", "media_cache.json")
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", str(7 * 24 * 3600)))  # секунды
+MEDIA_CACHE_MAX_ENTRIES = int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", "5000"))
+
+# Параллельная загрузка слайдшоу: запросов одновременно на одну задачу
+SLIDESHOW_CONCURRENCY = int(os.getenv("SLIDESHOW_CONCURRENCY", "6"))
+
+# Пул FFmpeg (transcode.py): libx265 сам многопоточный → по умолчанию половина ядер
+FFMPEG_WORKERS = int(os.getenv("FFMPEG_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", "60"))                   # секунды на одну задачу
+FFMPEG_PROGRESS_INTERVAL = float(os.getenv("FFMPEG_PROGRESS_INTERVAL", "3"))  # как часто обновлять прогресс, с
+
+# Компрессия под размер (downloaders.compress_video_ffmpeg)
+UPLOAD_LIMIT_MB = float(os.getenv("UPLOAD_LIMIT_MB", "40"))                   # больше — выбираем версию поменьше / сжимаем
+TELEGRAM_UPLOAD_MAX_MB = 50                                                      # жёсткий лимит Bot API на файл
+COMPRESS_TARGET_MB = float(os.getenv("COMPRESS_TARGET_MB", str(UPLOAD_LIMIT_MB)))  # целевой размер файла
+COMPRESS_MIN_VIDEO_KBPS = int(os.getenv("COMPRESS_MIN_VIDEO_KBPS", "250"))    # ниже — уже обрезаем длительность
+COMPRESS_TIME_BUDGET = float(os.getenv("COMPRESS_TIME_BUDGET", "120"))        # секунд на всю компрессию
+COMPRESS_SPEED_ESTIMATE = float(os.getenv("COMPRESS_SPEED_ESTIMATE", "0.5"))  # начальная оценка: с работы на 1 с видео
+
+# Кэш результатов yt-dlp extract_info (ytdlp_client.py)
+YTDLP_INFO_TTL = int(os.getenv("YTDLP_INFO_TTL", "300"))  # секунды (ссылки на CDN живут недолго)
+YTDLP_INFO_CACHE_SIZE = 200
+
+# Исполнитель для yt-dlp (ytdlp_client.py): "thread" или "process" (несколько ядер)
+YTDLP_BACKEND = os.getenv("YTDLP_BACKEND", "thread")
+YTDLP_WORKERS = int(os.getenv("YTDLP_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Планировщик загрузок (scheduler.py)
+SCHEDULER_GLOBAL_LIMIT = int(os.getenv("SCHEDULER_GLOBAL_LIMIT", "6"))  # загрузок одновременно всего
+SCHEDULER_PLATFORM_LIMITS = {'tiktok': 4, 'instagram': 2, 'youtube': 2}  # ... и на платформу
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "50"))       # больше — отказываем
+SCHEDULER_MAX_QUEUE_PER_CHAT = int(os.getenv("SCHEDULER_MAX_QUEUE_PER_CHAT", "15"))  # ... из одного чата
+SCHEDULER_MAX_QUEUE_PER_USER = int(os.getenv("SCHEDULER_MAX_QUEUE_PER_USER", "5"))   # ... от одного пользователя
+SCHEDULER_POSITION_INTERVAL = float(os.getenv("SCHEDULER_POSITION_INTERVAL", "5"))  # номер в очереди правим не чаще, с
+
+# Подпись отдельным сообщением после ссылки (handlers.py): загрузка не ждёт, окно открыто столько секунд
+CAPTION_WAIT = float(os.getenv("CAPTION_WAIT", "1.5"))
+
+# Исходящие запросы к Bot API (rate_limiter.py), лимиты из документации Telegram
+TG_GLOBAL_PER_SECOND = float(os.getenv("TG_GLOBAL_PER_SECOND", "30"))  # всего по всем чатам
+TG_PRIVATE_PER_SECOND = 1.0   # в личный чат
+TG_PRIVATE_BURST = 3
+TG_GROUP_PER_MINUTE = 20      # в группу
+TG_GROUP_BURST = 10
+TG_MAX_RETRIES = 3            # повторов после 429 (retry_after)
+TG_COSMETIC_RESERVE = 0.5     # доля корзины чата, которую правки/удаления оставляют отправкам
+DELETE_BATCH_WINDOW = float(os.getenv("DELETE_BATCH_WINDOW", "1.0"))  # копим удаления чата столько секунд → один deleteMessages
+
+# Статистика реакций (stats.py)
+STATS_MAX_MESSAGES = int(os.getenv("STATS_MAX_MESSAGES", "10000"))  # сколько последних видео отслеживаем
+STATS_TOP_K = int(os.getenv("STATS_TOP_K", "3"))                    # длина топа в /stats и еженедельном отчёте
+STATS_FLUSH_INTERVAL = 10  # write-behind: счётчики в базу пачкой раз в столько секунд
+STATS_FLUSH_EVENTS = 200   # ... или сразу после стольких изменений
+
+# Сводки реакций по времени (rollups.py): часы → дни → месяцы
+ROLLUP_HOURLY_KEEP_HOURS = 7 * 24  # почасовые корзины за последнюю неделю
+ROLLUP_DAILY_KEEP_DAYS = 90        # потом по дням
+ROLLUP_MONTHLY_KEEP_MONTHS = 12    # потом по месяцам, старше – удаляются
+
+# Лог загрузок для /logs и /log (utils.download_log)
+LOG_MAX_URLS = int(os.getenv("LOG_MAX_URLS", "500"))         # столько последних ссылок
+LOG_ENTRIES_PER_URL = int(os.getenv("LOG_ENTRIES_PER_URL", "50"))  # столько записей у ссылки
+
+# История загрузок на диске (history.py): /log и /logs с фильтрами
+HISTORY_DB = "history.db"
+HISTORY_KEEP_DAYS = int(os.getenv("HISTORY_KEEP_DAYS", "30"))
+HISTORY_FLUSH_INTERVAL = 5   # секунд между пачками записей
+HISTORY_FLUSH_EVENTS = 200   # ... или столько записей
+
+# Метрики (metrics.py): /perf и локальный HTTP /metrics для Prometheus
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 – HTTP-эндпоинт выключен
+
+# Монитор цикла событий и профайлер (loop_monitor.py)
+LOOP_LAG_INTERVAL = 0.5      # как часто замеряем опоздание цикла, с
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "1.0"))  # зависание дольше → снимок стека
+PROFILE_MAX_SECONDS = 60     # /profile не дольше
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}  # /profile, /stalls
@@ -3,12 +3,29 @@ import json
 import os
 import re
 import time
-from typing import Optional, Tuple, Union, List, Dict, Any
-import subprocess
+from typing import Any, Awaitable, Dict, List, Optional, Tuple, Union
+import shutil
 import aiohttp
-import yt_dlp
-from config import TIKTOK_APIS, INSTAGRAM_APIS
-from utils import add_to_log, username_context
+from config import (
+    COMPRESS_MIN_VIDEO_KBPS,
+    COMPRESS_SPEED_ESTIMATE,
+    COMPRESS_TARGET_MB,
+    COMPRESS_TIME_BUDGET,
+    TELEGRAM_UPLOAD_MAX_MB,
+    UPLOAD_LIMIT_MB,
+    INSTAGRAM_APIS,
+    SLIDESHOW_CONCURRENCY,
+    TIKTOK_APIS,
+    TIKTOK_HEDGE_DELAY,
+    TIKTOK_RACE_WIDTH,
+    TIKTOK_SLIDESHOW_GRACE,
+)
+from utils import add_to_log
+import endpoint_health
+import metrics
+import http_pool
+import transcode
+import ytdlp_client
 import logging
 
 logger = logging.getLogger(__name__)
@@ -16,46 +33,414 @@ logger = logging.getLogger(__name__)
 
 
 
-async def compress_video_ffmpeg(input_path: str, output_path: str, target_size_mb: float = 40) -> bool:
-    """Компрессия видео FFmpeg H.265 → <40MB (Telegram safe)."""
+# Скорость кодирования (секунд работы на секунду видео), EWMA по последним задачам
+encode_speed = COMPRESS_SPEED_ESTIMATE
+
+def plan_video_bitrate(target_bytes: float, duration: float, audio_kbps: int) -> int:
+    """Битрейт видео (kbps), чтобы файл длительностью duration уложился в target_bytes."""
+    total_kbps = target_bytes * 8 / 1000 / duration * 0.97  # ~3% на контейнер
+    return int(total_kbps - audio_kbps)
+
+@metrics.timed("stage_seconds", stage="compress")
+async def compress_video_ffmpeg(input_path: str, output_path: str, target_size_mb: float = COMPRESS_TARGET_MB) -> bool:
+    """
+    Компрессия видео FFmpeg H.265 под размер (Telegram safe).
+
+    Длительность берётся из ffprobe, битрейт считается так, чтобы файл лёг
+    чуть ниже target_size_mb. Два прохода — если укладываемся в бюджет времени,
+    иначе один проход ABR. Повтор на ступень ниже — только если не влезли.
+    """
+    global encode_speed
     try:
         # Проверяем FFmpeg в PATH
-        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
+        if not shutil.which('ffmpeg'):
+            raise FileNotFoundError("ffmpeg not found")
+        
+        info = await transcode.probe(input_path)
+        try:
+            duration = float(info['format']['duration'])
+        except (KeyError, TypeError, ValueError):
+            raise Exception("PROBE_FAIL")
+        has_audio = any(s.get('codec_type') == 'audio' for s in info.get('streams', []))
         
-        cmd = [
-            'ffmpeg', '-y', '-i', input_path,
-            '-vf', 'scale=-2:720', # 720p
-            '-c:v', 'libx265', '-crf', '26', '-preset', 'fast',
-            '-c:a', 'aac', '-b:a', '128k',
-            '-maxrate', '1500k', '-bufsize', '3000k',
-            '-t', '180', # Макс 3 мин
-            output_path
-        ]
+        target_bytes = target_size_mb * 1024 * 1024
+        audio_kbps = 128 if has_audio else 0
+        video_kbps = plan_video_bitrate(target_bytes, duration, audio_kbps)
+        if has_audio and video_kbps < 800:
+            audio_kbps = 64  # длинное видео: экономим на звуке
+            video_kbps = plan_video_bitrate(target_bytes, duration, audio_kbps)
+        
+        if video_kbps < COMPRESS_MIN_VIDEO_KBPS:
+            # Даже минимальное качество не влезает → обрезаем по длительности
+            duration = target_bytes * 8 / 1000 / (COMPRESS_MIN_VIDEO_KBPS + audio_kbps) * 0.97
+            video_kbps = COMPRESS_MIN_VIDEO_KBPS
+            await add_to_log("FFMPEG TRIM", f"{duration:.0f}s @ {video_kbps}k", api="compress")
+        
+        # Бюджет – чистое время кодирования: ожидание слота FFmpeg в очереди не считается
+        timings: List[float] = []
+        two_pass = 2 * duration * encode_speed < COMPRESS_TIME_BUDGET * 0.8
+        orig_size = os.path.getsize(input_path) / (1024*1024)
+        
+        # Повтор пишет в отдельный файл: если он сорвётся, первый результат останется
+        retry_path = os.path.splitext(output_path)[0] + "_retry.mp4"
+        for attempt in range(2):
+            out_path = output_path if attempt == 0 else retry_path
+            audio_args = ['-c:a', 'aac', '-b:a', f'{audio_kbps}k'] if has_audio else ['-an']
+            base_args = [
+                '-y', '-i', input_path, '-t', f'{duration:.2f}',
+                '-vf', "scale=-2:'min(720,ih)'",  # не больше 720p
+                '-c:v', 'libx265', '-preset', 'fast', '-b:v', f'{video_kbps}k', '-tag:v', 'hvc1',
+            ]
+            spent_before = len(timings)
+            
+            if two_pass:
+                stats_prefix = f"downloads/x265_{os.urandom(4).hex()}"
+                try:
+                    ok = await transcode.run_ffmpeg(
+                        base_args + ['-x265-params', f'pass=1:stats={stats_prefix}.log', '-an', '-f', 'null', os.devnull],
+                        timeout=max(1.0, COMPRESS_TIME_BUDGET - sum(timings)), duration=duration,
+                        label="H.265 1/2", timings=timings,
+                    ) and await transcode.run_ffmpeg(
+                        base_args + ['-x265-params', f'pass=2:stats={stats_prefix}.log'] + audio_args
+                        + ['-movflags', '+faststart', out_path],
+                        timeout=max(1.0, COMPRESS_TIME_BUDGET - sum(timings)), duration=duration,
+                        label="H.265 2/2", timings=timings,
+                    )
+                finally:
+                    for suffix in ('.log', '.log.cutree', '.log.temp', '.log.cutree.temp'):
+                        if os.path.exists(stats_prefix + suffix):
+                            os.remove(stats_prefix + suffix)
+            else:
+                ok = await transcode.run_ffmpeg(
+                    base_args + ['-maxrate', f'{int(video_kbps * 1.2)}k', '-bufsize', f'{video_kbps * 2}k']
+                    + audio_args + ['-movflags', '+faststart', out_path],
+                    timeout=max(1.0, COMPRESS_TIME_BUDGET - sum(timings)), duration=duration,
+                    label="H.265", timings=timings,
+                )
+            
+            if not ok or not os.path.exists(out_path):
+                _remove_quietly(out_path)
+                break
+            if out_path != output_path:
+                os.replace(out_path, output_path)
+            
+            passes = 2 if two_pass else 1
+            speed = sum(timings[spent_before:]) / (duration * passes)
+            encode_speed = 0.7 * encode_speed + 0.3 * speed
+            
+            new_size = os.path.getsize(output_path) / (1024*1024)
+            if new_size <= target_size_mb:
+                ratio = (1 - new_size/orig_size) * 100
+                await add_to_log(f"FFMPEG ↓{ratio:.0f}%", f"{orig_size:.1f}→{new_size:.1f}MB",
+                                 api=f"H.265 {video_kbps}k {passes}-pass")
+                return True
+            
+            # Не влезли → одна ступень ниже, одним проходом
+            await add_to_log("FFMPEG RETRY", f"{new_size:.1f}MB > {target_size_mb}MB", api="compress")
+            video_kbps = int(video_kbps * target_size_mb / new_size * 0.9)
+            two_pass = False
+            if video_kbps < COMPRESS_MIN_VIDEO_KBPS or sum(timings) >= COMPRESS_TIME_BUDGET:
+                break
         
-        result = subprocess.run(cmd, capture_output=True, timeout=60)
-        if result.returncode == 0 and os.path.exists(output_path):
-            orig_size = os.path.getsize(input_path) / (1024*1024)
+        # Цель не достигнута: лучший результат годится, если Telegram его примет
+        if os.path.exists(output_path):
             new_size = os.path.getsize(output_path) / (1024*1024)
-            ratio = (1 - new_size/orig_size) * 100
-            await add_to_log("", f"FFMPEG ↓{ratio:.0f}%", f"{orig_size:.1f}→{new_size:.1f}MB", api="H.265")
-            return True
+            if new_size <= TELEGRAM_UPLOAD_MAX_MB:
+                await add_to_log("FFMPEG ≈", f"{orig_size:.1f}→{new_size:.1f}MB (> {target_size_mb}MB)", api="compress")
+                return True
+        _remove_quietly(output_path)
         return False
     except Exception as e:
-        await add_to_log("", "FFMPEG FAIL", str(e)[:50], api="compress")
+        _remove_quietly(output_path)
+        await add_to_log("FFMPEG FAIL", str(e)[:50], api="compress")
         return False
 
-async def download_file(url: str, filename: str, session: aiohttp.ClientSession, headers: dict) -> str:
-    """Универсальная загрузка файла по прямой ссылке"""
+
+def _remove_quietly(path: str) -> None:
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError:
+        pass
+
+
+# Кодеки, которые можно положить в MP4 без перекодирования (и которые Telegram проигрывает)
+MP4_VIDEO_CODECS = {'h264', 'hevc'}
+MP4_AUDIO_CODECS = {'aac', 'mp3'}
+
+@metrics.timed("stage_seconds", stage="remux")
+async def convert_to_mp4(filename: str) -> str:
+    """
+    webm/mkv/mov → mp4 через пул FFmpeg (исходник удаляется и при успехе, и при ошибке).
+
+    Совместимые потоки копируются (remux — миллисекунды), несовместимые
+    перекодируются быстрым пресетом. +faststart — воспроизведение сразу.
+    """
+    base, ext = os.path.splitext(filename)
+    if ext.lower() not in ('.webm', '.mkv', '.mov'):
+        return filename
+    mp4_filename = base + '.mp4'
+    
+    info = await transcode.probe(filename)
+    streams = info.get('streams', [])
+    video_codecs = {s.get('codec_name') for s in streams if s.get('codec_type') == 'video'}
+    audio_codecs = {s.get('codec_name') for s in streams if s.get('codec_type') == 'audio'}
+    copy_video = bool(video_codecs) and video_codecs <= MP4_VIDEO_CODECS
+    copy_audio = audio_codecs <= MP4_AUDIO_CODECS
+    
+    args = ['-y', '-i', filename, '-map', '0:v:0?', '-map', '0:a:0?']
+    args += ['-c:v', 'copy'] if copy_video else ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p']
+    if copy_video and 'hevc' in video_codecs:
+        args += ['-tag:v', 'hvc1']  # с тегом hev1 (по умолчанию) iOS не проигрывает видео в чате
+    args += ['-c:a', 'copy'] if copy_audio else ['-c:a', 'aac', '-b:a', '128k']
+    args += ['-movflags', '+faststart', mp4_filename]
+    
+    label = "remux" if copy_video and copy_audio else f"{ext[1:]}→mp4"
+    try:
+        duration = float(info['format']['duration'])
+    except (KeyError, TypeError, ValueError):
+        duration = None
+    if not await transcode.run_ffmpeg(args, duration=duration, label=label):
+        for path in (filename, mp4_filename):
+            if os.path.exists(path):
+                os.remove(path)
+        raise Exception("MP4_CONVERT_FAIL")
+    os.remove(filename)
+    return mp4_filename
+
+@metrics.timed("stage_seconds", stage="download", source="http")
+async def download_file(
+    url: str,
+    filename: str,
+    session: Optional[aiohttp.ClientSession] = None,
+    headers: Optional[dict] = None,
+) -> str:
+    """Универсальная загрузка файла по прямой ссылке (через общий пул соединений)"""
     os.makedirs('downloads', exist_ok=True)
+    session = session or http_pool.get_session('media')
     async with session.get(url, headers=headers) as resp:
         if resp.status == 200:
+            size = 0
             with open(filename, 'wb') as f:
                 async for chunk in resp.content.iter_chunked(8192):
                     f.write(chunk)
+                    size += len(chunk)
+            metrics.inc("downloaded_bytes_total", size, source="http")
             return filename
     raise Exception("FILE_DOWNLOAD_FAIL")
 
-async def download_tiktok(url: str, username: Optional[str] = None) -> Tuple[Union[str, Dict], str]:
+def api_display_name(api_base: str) -> str:
+    """Короткое имя API для логов (хост)"""
+    return api_base.split('/')[2] if '/' in api_base else api_base[:30]
+
+def size_limited_format(limit_mb: float = UPLOAD_LIMIT_MB, max_height: int = 720, prefer_mp4: bool = False) -> str:
+    """
+    Формат yt-dlp: лучшая версия, которая влезает в лимит ещё до скачивания.
+
+    yt-dlp сам заполняет filesize_approx = tbr × duration, поэтому фильтруем
+    сначала по точному размеру, потом по оценке, потом DASH (видео + звук).
+    Если ничего не влезло — лучшая версия ≤720p, её потом сожмём.
+    """
+    h = f"[height<={max_height}]"
+    mp4 = "[ext=mp4]" if prefer_mp4 else ""
+    specs = [
+        f"b{h}{mp4}[filesize<{limit_mb:g}M]",
+        f"b{h}{mp4}[filesize_approx<{limit_mb:g}M]",
+        f"b{h}[filesize<{limit_mb:g}M]",
+        f"b{h}[filesize_approx<{limit_mb:g}M]",
+        f"bv*{h}[filesize_approx<{limit_mb * 0.9:g}M]+ba[filesize_approx<{limit_mb * 0.1:g}M]",
+        f"b{h}{mp4}",
+        "b",
+    ]
+    return "/".join(dict.fromkeys(specs))
+
+def select_tiktok_variant(variants: List[Dict[str, Any]], limit_mb: float = UPLOAD_LIMIT_MB) -> Optional[str]:
+    """Лучшая версия TikTok-видео (HD → обычная), которая влезает в лимит по размеру из API."""
+    limit = limit_mb * 1024 * 1024
+    for variant in variants:
+        try:
+            size = int(variant.get('size') or 0)
+        except (TypeError, ValueError):
+            size = 0
+        if size and size <= limit:
+            return variant['url']
+    # Размеры неизвестны или ничего не влезло → обычная версия (дальше сожмём)
+    return variants[-1]['url'] if variants else None
+
+class ContentUnavailable(Exception):
+    """API ответил штатно, но видео нет (приватное/удалённое) – это не сбой endpoint'а."""
+
+
+async def fetch_tiktok_api(session: aiohttp.ClientSession, api_base: str, url: str, headers: dict) -> Optional[Dict[str, Any]]:
+    """
+    Один запрос к TikTok API → {'images', 'music', 'play', 'variants'} или None.
+    Ответ с code != 0 (кроме лимитов самого API) → ContentUnavailable.
+    """
+    async with session.get(api_base + url, headers=headers) as resp:
+        if resp.status != 200:
+            return None
+        data = await resp.json()
+        if data.get('code') != 0:
+            if 'limit' in str(data.get('msg', '')).lower():
+                return None
+            raise ContentUnavailable(str(data.get('msg') or data.get('code')))
+        if not data.get('data'):
+            return None
+        item = data['data']
+        if not item.get('images') and not item.get('play'):
+            return None
+        return {
+            'images': item.get('images') or [],
+            'music': item.get('music'),
+            'play': item.get('play'),
+            # Версии видео с размерами из ответа API (tikwm: hdplay/hd_size, play/size)
+            'variants': [
+                {'url': item[url_key], 'size': item.get(size_key)}
+                for url_key, size_key in (('hdplay', 'hd_size'), ('play', 'size'))
+                if str(item.get(url_key) or '').startswith('http')
+            ],
+        }
+
+@metrics.timed("stage_seconds", stage="resolve", source="tiktok-api")
+async def race_tiktok_apis(
+    url: str,
+    session: aiohttp.ClientSession,
+    headers: dict,
+    apis: Optional[List[str]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Гонка TikTok API: до TIKTOK_RACE_WIDTH запросов одновременно,
+    каждый следующий стартует через TIKTOK_HEDGE_DELAY (или сразу после ошибки).
+
+    Слайдшоу принимается сразу. Видео — после окна TIKTOK_SLIDESHOW_GRACE,
+    если за это время никто не вернул слайдшоу. Остальные запросы отменяются.
+    """
+    apis = endpoint_health.rank(list(apis or TIKTOK_APIS))
+    loop = asyncio.get_running_loop()
+    pending: Dict[asyncio.Task, Tuple[int, str, float]] = {}
+    next_idx = 0
+    last_launch = float('-inf')
+    video_result = None
+    grace_deadline = None
+    
+    try:
+        while True:
+            # Запускаем следующие endpoint'ы (hedge)
+            while (next_idx < len(apis) and len(pending) < TIKTOK_RACE_WIDTH
+                   and (not pending or loop.time() - last_launch >= TIKTOK_HEDGE_DELAY)):
+                api_base = apis[next_idx]
+                next_idx += 1
+                if not video_result:
+                    await add_to_log(f"TikTok API {next_idx}", "Checking...", api=api_display_name(api_base))
+                task = asyncio.create_task(fetch_tiktok_api(session, api_base, url, headers))
+                last_launch = loop.time()
+                pending[task] = (next_idx, api_base, last_launch)
+            
+            if not pending:
+                break
+            
+            now = loop.time()
+            timeouts = []
+            if next_idx < len(apis) and len(pending) < TIKTOK_RACE_WIDTH:
+                timeouts.append(last_launch + TIKTOK_HEDGE_DELAY - now)
+            if grace_deadline is not None:
+                timeouts.append(grace_deadline - now)
+            timeout = max(0.0, min(timeouts)) if timeouts else None
+            
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i, api_base, started = pending.pop(task)
+                api_name = api_display_name(api_base)
+                try:
+                    result = task.result()
+                except ContentUnavailable:
+                    # Endpoint жив, просто этого видео у него нет
+                    endpoint_health.record_success(api_base, loop.time() - started)
+                    last_launch = float('-inf')
+                    continue
+                except Exception:
+                    result = None  # Silent fail during search
+                if result:
+                    endpoint_health.record_success(api_base, loop.time() - started)
+                else:
+                    endpoint_health.record_failure(api_base, loop.time() - started)
+                    last_launch = float('-inf')  # ошибка → следующий endpoint без ожидания
+                    continue
+                
+                result.update(api=api_name, i=i)
+                if result['images']:
+                    await add_to_log(f"TikTok API {i}", f"SLIDESHOW: {len(result['images'])} imgs", api=api_name)
+                    return result
+                if not video_result:
+                    video_result = result
+                    grace_deadline = loop.time() + TIKTOK_SLIDESHOW_GRACE
+                    await add_to_log(f"TikTok API {i}", "Video found (looking for slides...)", api=api_name)
+            
+            if video_result and loop.time() >= grace_deadline:
+                break
+        
+        return video_result
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+async def download_slideshow(
+    image_urls: List[str],
+    prefix: str,
+    headers: Optional[dict] = None,
+    audio_url: Optional[str] = None,
+    audio_download: Optional[Awaitable[Optional[str]]] = None,
+) -> Dict[str, Any]:
+    """
+    Параллельная загрузка слайдшоу: не более SLIDESHOW_CONCURRENCY запросов,
+    музыка качается вместе с картинками (по ссылке или готовой корутиной).
+    Неудачные картинки пропускаются — альбом уходит с тем, что скачалось.
+    """
+    semaphore = asyncio.Semaphore(SLIDESHOW_CONCURRENCY)
+    
+    async def fetch(asset_url: str, filename: str) -> Optional[str]:
+        async with semaphore:
+            try:
+                return await download_file(asset_url, filename, headers=headers)
+            except Exception as e:
+                logger.warning(f"Slideshow asset failed {filename}: {e}")
+                if os.path.exists(filename):
+                    os.remove(filename)
+                return None
+    
+    async def fetch_audio() -> Optional[str]:
+        if audio_download is not None:
+            try:
+                return await audio_download
+            except Exception as e:
+                logger.warning(f"Audio download failed: {e}")
+                return None
+        if audio_url:
+            return await fetch(audio_url, f"{prefix}_audio.mp3")
+        return None
+    
+    # Музыку запускаем первой, чтобы она не стояла в очереди за картинками
+    audio_task = asyncio.create_task(fetch_audio())
+    try:
+        results = await asyncio.gather(*(
+            fetch(img_url, f"{prefix}_{idx}.jpg") for idx, img_url in enumerate(image_urls)
+        ))
+        audio_path = await audio_task
+    finally:
+        audio_task.cancel()
+    
+    image_paths = [path for path in results if path]
+    if not image_paths:
+        if audio_path and os.path.exists(audio_path):
+            os.remove(audio_path)
+        raise Exception("SLIDESHOW_FAIL")
+    if len(image_paths) < len(image_urls):
+        logger.warning(f"Slideshow partial: {len(image_paths)}/{len(image_urls)} images")
+    return {'images': image_paths, 'audio': audio_path}
+
+async def download_tiktok(url: str) -> Tuple[Union[str, Dict], str]:
     """TikTok: API → AutoCompress → yt-dlp fallback"""
     os.makedirs('downloads', exist_ok=True)
     start_time = time.time()
@@ -63,210 +448,157 @@ async def download_tiktok(url: str, username: Optional[str] = None) -> Tuple[Uni
     # Photo skip
     # Photo skip removed
     # if '/photo/' in url.lower():
-    #     await add_to_log(url, "TikTok фото", "ОСТАВЛЯЕМ ССЫЛКУ", username=username, platform="tiktok")
+    #     await add_to_log("TikTok фото", "ОСТАВЛЯЕМ ССЫЛКУ")
     #     raise Exception("PHOTO")
     
     headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
     
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=25), headers=headers) as session:
-        video_candidate = None
+    session = http_pool.get_session('tiktok')
+    short_id = re.search(r'tiktok.com/([^\s/]+)', url).group(1)[:8] if 'tiktok.com' in url else os.urandom(6).hex()
+    video_candidate = None
+    
+    # 1️⃣ API: гонка endpoint'ов (слайдшоу приоритетнее видео)
+    found = await race_tiktok_apis(url, session, headers)
+    if found:
+        i, api_name = found['i'], found['api']
         
-        # 1️⃣ API попытки (с приоритетом слайдшоу)
-        for i, api_base in enumerate(TIKTOK_APIS, 1):
-            api_name = api_base.split('/')[2] if '/' in api_base else api_base[:30]
-            api_start = time.time()
-            
+        # 📸 SLIDESHOW (IMAGES)
+        if found['images']:
             try:
-                # Log only if it's the first attempt or if we don't have a candidate yet
-                if not video_candidate:
-                    await add_to_log(url, f"TikTok API {i}", f"Checking...",
-                                   username=username, api=api_name, platform="tiktok")
+                images = found['images']
                 
-                async with session.get(api_base + url) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        if data.get('code') == 0:
-                            
-                            # 📸 SLIDESHOW (IMAGES) - IMMEDIATE SUCCESS
-                            if data['data'].get('images'):
-                                try:
-                                    images = data['data']['images']
-                                    music_url = data['data']['music']
-                                    short_id = re.search(r'tiktok.com/([^\s/]+)', url).group(1)[:8] if 'tiktok.com' in url else os.urandom(6).hex()
-                                    
-                                    await add_to_log(url, f"TikTok API {i}", f"SLIDESHOW: {len(images)} imgs",
-                                                   username=username, api=api_name, platform="tiktok")
-                                    
-                                    # Скачиваем картинки
-                                    image_paths = []
-                                    for idx, img_url in enumerate(images):
-                                        img_filename = f"downloads/tiktok_slide_{short_id}_{idx}.jpg"
-                                        await download_file(img_url, img_filename, session, headers)
-                                        image_paths.append(img_filename)
-                                    
-                                    # Скачиваем музыку
-                                    audio_path = f"downloads/tiktok_audio_{short_id}.mp3"
-                                    await download_file(music_url, audio_path, session, headers)
-                                    
-                                    total_time = time.time() - start_time
-                                    await add_to_log(url, f"TikTok API {i}", f"SLIDESHOW OK {len(image_paths)} pics",
-                                                   username=username, api=api_name, platform="tiktok", duration=total_time)
-                                    
-                                    return {'images': image_paths, 'audio': audio_path}, 'slideshow'
-                                    
-                                except Exception as e:
-                                    logger.error(f"Slideshow download error: {e}")
-                                    # Continue searching...
-                                    
-                            # 📹 VIDEO FOUND - STORE CANDIDATE
-                            if not video_candidate:
-                                video_url = data['data']['play']
-                                short_id = re.search(r'tiktok.com/([^\s/]+)', url).group(1)[:8] if 'tiktok.com' in url else os.urandom(6).hex()
-                                video_candidate = {
-                                    'url': video_url,
-                                    'id': short_id,
-                                    'api': api_name,
-                                    'i': i
-                                }
-                                # Don't return yet! Look for slideshow in other APIs
-                                await add_to_log(url, f"TikTok API {i}", f"Video found (looking for slides...)",
-                                               username=username, api=api_name, platform="tiktok")
-                            
-            except Exception as e:
-                pass # Silent fail during search
+                # Картинки и музыка параллельно
+                slideshow = await download_slideshow(
+                    images, f"downloads/tiktok_slide_{short_id}_{os.urandom(3).hex()}",
+                    headers=headers, audio_url=found['music'],
+                )
                 
-        # 🏁 LOOP FINISHED - CHECK CANDIDATE
-        if video_candidate:
-            try:
-                vc = video_candidate
-                raw_filename = f"downloads/tiktok_raw_{vc['id']}.mp4"
-                
-                # Скачиваем
-                file_path = await download_file(vc['url'], raw_filename, session, headers)
-                
-                # ✅ АВТОКОМПРЕССИЯ >40MB
-                file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-                final_filename = file_path
+                total_time = time.time() - start_time
+                await add_to_log(f"TikTok API {i}", f"SLIDESHOW OK {len(slideshow['images'])}/{len(images)} pics",
+                               api=api_name, duration=total_time)
                 
-                if file_size_mb > 40:
-                    await add_to_log(url, "TikTok RAW", f"{file_size_mb:.1f}MB → COMPRESS",
-                                   username=username, api=vc['api'], platform="tiktok")
-                    compressed_filename = file_path.replace('raw_', 'opt_')
-                    
-                    if await compress_video_ffmpeg(file_path, compressed_filename):
-                        os.remove(file_path)
-                        final_filename = compressed_filename
-                    else:
-                        # Fallback trim
-                        trimmed_filename = file_path.replace('raw_', 'trim_')
-                        subprocess.run([
-                            'ffmpeg', '-y', '-i', file_path, '-t', '180', '-c', 'copy', trimmed_filename
-                        ], capture_output=True)
-                        os.remove(file_path)
-                        final_filename = trimmed_filename
+                return slideshow, 'slideshow'
                 
-                total_time = time.time() - start_time
-                final_size_mb = os.path.getsize(final_filename) / (1024 * 1024)
-                await add_to_log(url, f"TikTok API {vc['i']}", f"VIDEO OK {final_size_mb:.1f}MB ✓",
-                               username=username, api=vc['api'], platform="tiktok", duration=total_time)
-                return final_filename, 'video'
             except Exception as e:
-                 logger.error(f"Video candidate download failed: {e}")
-                 # Fallback to YT-DLP if candidate failed logic
+                logger.error(f"Slideshow download error: {e}")
         
-        # 2️⃣ YT-DLP FALLBACK (100% работает)
-        await add_to_log(url, "YT-DLP", "TikTok FAILBACK START", username=username, platform="tiktok")
-        try:
-            # Сначала получаем инфо без скачивания
-            info_opts = {'quiet': True, 'extract_flat': False}
-            
-            def get_info():
-                with yt_dlp.YoutubeDL(info_opts) as ydl:
-                    return ydl.extract_info(url, download=False)
-            
-            info = await asyncio.to_thread(get_info)
-            
-            # 📸 SLIDESHOW CHECK (YT-DLP)
-            if info.get('_type') == 'playlist' or (info.get('entries') and len(info['entries']) > 0):
-                 await add_to_log(url, "YT-DLP", "SLIDESHOW DETECTED", username=username, platform="tiktok")
-                 
-                 image_urls = []
-                 # Пытаемся найти картинки
-                 if info.get('entries'):
-                     for entry in info['entries']:
-                         # yt-dlp для tiktok slideshow часто возвращает список, где каждое entry - это url картинки или видео
-                         if entry.get('url'):
-                             image_urls.append(entry['url'])
-                         elif entry.get('thumbnails'): # Иногда тут
-                             image_urls.append(entry['thumbnails'][-1]['url'])
-
-                 # Если не нашли в entries, иногда они в formats (редко для yt-dlp slideshow)
-                 
-                 if image_urls:
-                     image_paths = []
-                     for idx, img_url in enumerate(image_urls):
-                         filename = f"downloads/tiktok_yt_{os.urandom(6).hex()}_{idx}.jpg"
-                         await download_file(img_url, filename, session, headers)
-                         image_paths.append(filename)
-                     
-                     # Audio
-                     audio_path = None
-                     # Пытаемся найти аудио ссылку
-                     # Часто в info есть 'requested_downloads' или 'url' pointing to mp3 if extracted
-                     # Для простоты, попробуем скачать аудио отдельно через yt-dlp 'bestaudio'
-                     
-                     audio_opts = {
-                        'format': 'bestaudio/best',
-                        'outtmpl': f'downloads/tiktok_audio_yt_{os.urandom(6).hex()}.%(ext)s',
-                        'quiet': True,
-                     }
-                     
-                     def download_audio():
-                        with yt_dlp.YoutubeDL(audio_opts) as ydl:
-                            return ydl.prepare_filename(ydl.extract_info(url, download=True))
-
-                     try:
-                         audio_path = await asyncio.to_thread(download_audio)
-                     except Exception as e:
-                         logger.warning(f"Audio download failed: {e}")
-
-                     return {'images': image_paths, 'audio': audio_path}, 'slideshow'
-
-            # Если не слайдшоу, качаем как видео
-            ydl_opts = {
-                'format': 'best[height<=720][ext=mp4]/best',
-                'outtmpl': f'downloads/tiktok_fallback_{os.urandom(6).hex()}.%(ext)s',
-                'quiet': True,
+        # 📹 VIDEO
+        if found['play']:
+            video_candidate = {
+                'url': select_tiktok_variant(found['variants']) or found['play'],
+                'id': short_id,
+                'api': api_name,
+                'i': i
             }
             
-            def run_yt_dlp():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    return ydl.prepare_filename(info)
+    # 🏁 VIDEO CANDIDATE
+    if video_candidate:
+        try:
+            vc = video_candidate
+            raw_filename = f"downloads/tiktok_raw_{vc['id']}.mp4"
             
-            fallback_filename = await asyncio.to_thread(run_yt_dlp)
+            # Скачиваем
+            file_path = await download_file(vc['url'], raw_filename, headers=headers)
             
-            # Компрессия fallback
-            file_size_mb = os.path.getsize(fallback_filename) / (1024 * 1024)
-            final_filename = fallback_filename
+            # ✅ АВТОКОМПРЕССИЯ >40MB
+            file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
+            final_filename = file_path
             
-            if file_size_mb > 40:
-                compressed_filename = fallback_filename.replace('.mp4', '_opt.mp4')
-                if await compress_video_ffmpeg(fallback_filename, compressed_filename):
-                    os.remove(fallback_filename)
+            if file_size_mb > UPLOAD_LIMIT_MB:
+                await add_to_log("TikTok RAW", f"{file_size_mb:.1f}MB → COMPRESS", api=vc['api'])
+                compressed_filename = file_path.replace('raw_', 'opt_')
+                
+                if await compress_video_ffmpeg(file_path, compressed_filename):
+                    os.remove(file_path)
                     final_filename = compressed_filename
+                else:
+                    # Fallback trim
+                    trimmed_filename = file_path.replace('raw_', 'trim_')
+                    await transcode.run_ffmpeg(
+                        ['-y', '-i', file_path, '-t', '180', '-c', 'copy', trimmed_filename], label="Trim"
+                    )
+                    os.remove(file_path)
+                    final_filename = trimmed_filename
             
             total_time = time.time() - start_time
             final_size_mb = os.path.getsize(final_filename) / (1024 * 1024)
-            await add_to_log(url, "YT-DLP TikTok", f"FALLBACK OK {final_size_mb:.1f}MB ✓",
-                           username=username, platform="tiktok", duration=total_time)
+            await add_to_log(f"TikTok API {vc['i']}", f"VIDEO OK {final_size_mb:.1f}MB ✓",
+                           api=vc['api'], duration=total_time)
             return final_filename, 'video'
-            
         except Exception as e:
-            await add_to_log(url, "YT-DLP FAIL", str(e)[:50], username=username, platform="tiktok")
-            raise Exception("TIKTOK_FAIL")
+             logger.error(f"Video candidate download failed: {e}")
+             # Fallback to YT-DLP if candidate failed logic
+    
+    # 2️⃣ YT-DLP FALLBACK (100% работает)
+    await add_to_log("YT-DLP", "TikTok FAILBACK START")
+    try:
+        # Сначала получаем инфо без скачивания (кэшируется и переиспользуется ниже)
+        info = await ytdlp_client.extract_info(url)
+        
+        # 📸 SLIDESHOW CHECK (YT-DLP)
+        if info.get('_type') == 'playlist' or (info.get('entries') and len(info['entries']) > 0):
+             await add_to_log("YT-DLP", "SLIDESHOW DETECTED")
+             
+             image_urls = []
+             # Пытаемся найти картинки
+             if info.get('entries'):
+                 for entry in info['entries']:
+                     # yt-dlp для tiktok slideshow часто возвращает список, где каждое entry - это url картинки или видео
+                     if entry.get('url'):
+                         image_urls.append(entry['url'])
+                     elif entry.get('thumbnails'): # Иногда тут
+                         image_urls.append(entry['thumbnails'][-1]['url'])
+
+             # Если не нашли в entries, иногда они в formats (редко для yt-dlp slideshow)
+             
+             if image_urls:
+                 # Audio
+                 # Пытаемся найти аудио ссылку
+                 # Часто в info есть 'requested_downloads' или 'url' pointing to mp3 if extracted
+                 # Для простоты, попробуем скачать аудио отдельно через yt-dlp 'bestaudio'
+                 
+                 audio_opts = {
+                    'format': 'bestaudio/best',
+                    'outtmpl': f'downloads/tiktok_audio_yt_{os.urandom(6).hex()}.%(ext)s',
+                    'quiet': True,
+                 }
+                 
+                 # Картинки и аудио (yt-dlp по тому же info) параллельно
+                 slideshow = await download_slideshow(
+                     image_urls, f"downloads/tiktok_yt_{os.urandom(6).hex()}",
+                     headers=headers, audio_download=ytdlp_client.download(url, audio_opts),
+                 )
+                 return slideshow, 'slideshow'
+
+        # Если не слайдшоу, качаем как видео
+        ydl_opts = {
+            'format': size_limited_format(prefer_mp4=True),
+            'outtmpl': f'downloads/tiktok_fallback_{os.urandom(6).hex()}.%(ext)s',
+            'quiet': True,
+        }
+        
+        fallback_filename = await ytdlp_client.download(url, ydl_opts)
+        
+        # Компрессия fallback
+        file_size_mb = os.path.getsize(fallback_filename) / (1024 * 1024)
+        final_filename = fallback_filename
+        
+        if file_size_mb > UPLOAD_LIMIT_MB:
+            compressed_filename = fallback_filename.replace('.mp4', '_opt.mp4')
+            if await compress_video_ffmpeg(fallback_filename, compressed_filename):
+                os.remove(fallback_filename)
+                final_filename = compressed_filename
+        
+        total_time = time.time() - start_time
+        final_size_mb = os.path.getsize(final_filename) / (1024 * 1024)
+        await add_to_log("YT-DLP TikTok", f"FALLBACK OK {final_size_mb:.1f}MB ✓", duration=total_time)
+        return final_filename, 'video'
+        
+    except Exception as e:
+        await add_to_log("YT-DLP FAIL", str(e)[:50])
+        raise Exception("TIKTOK_FAIL")
 
-async def download_instagram(url: str, username: Optional[str] = None) -> Tuple[str, str]:
+async def download_instagram(url: str) -> Tuple[str, str]:
     """🚀 Instagram Reels 2026: 6 API + HTML + GraphQL + yt-dlp ULTIMATE FALLBACK"""
     os.makedirs('downloads', exist_ok=True)
     start_time = time.time()
@@ -281,213 +613,208 @@ async def download_instagram(url: str, username: Optional[str] = None) -> Tuple[
     shortcode_match = re.search(r'/([A-Za-z0-9_-]{11})/?', url)
     shortcode = shortcode_match.group(1) if shortcode_match else ''
     
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=35), headers=headers) as session:
-        # 🔥 1. НОВЫЕ РАБОЧИЕ API 2026 (замена мёртвых)
-        for i, api_base in enumerate(INSTAGRAM_APIS, 1):
-            api_name = api_base.split('/')[2]
-            api_start = time.time()
-            
-            try:
-                await add_to_log(url, f"Insta API {i}", f"{api_name} | API: {api_name}",
-                               username=username, api=api_name, platform="instagram")
-                
-                api_url = api_base + url
-                async with session.get(api_url) as resp:
-                    if resp.status == 200:
-                        content = await resp.text()
-                        
-                        # Современные Reels patterns
-                        patterns = [
-                            r'"(https://[^"\s]+scontent[^"\s]+(?:jpg|jpeg|mp4))"',
-                            r'"download_url":"(https://[^"]+scontent[^"]+(?:jpg|mp4))"',
-                            r'"video_url":"(https://[^"]+scontent[^"]+\.mp4)"',
-                            r'src="(https://[^"\s]+scontent[^"\s]+(?:jpg|mp4))"'
-                        ]
-                        
-                        for pattern in patterns:
-                            match = re.search(pattern, content, re.IGNORECASE)
-                            if match:
-                                media_url = match.group(1).replace('\\\\', '')
-                                if 'scontent' in media_url:
-                                    ext = 'jpg' if any(x in media_url.lower() for x in ['.jpg', '.jpeg']) else 'mp4'
-                                    filename = f"downloads/insta_api_{os.urandom(6).hex()}.{ext}"
-                                    
-                                    file_path = await download_file(media_url, filename, session, headers)
-                                    
-                                    # Автокомпрессия видео
-                                    if ext == 'mp4' and os.path.getsize(file_path) > 40 * 1024 * 1024:
-                                        compressed = file_path.replace('.mp4', '_opt.mp4')
-                                        if await compress_video_ffmpeg(file_path, compressed):
-                                            os.remove(file_path)
-                                            file_path = compressed
-                                    
-                                    total_time = time.time() - start_time
-                                    await add_to_log(url, f"Insta API {i}", f"{ext.upper()} OK ✓",
-                                                   username=username, api=api_name, platform="instagram", duration=total_time)
-                                    return file_path, ext
-            except Exception as e:
-                api_time = time.time() - api_start
-                await add_to_log(url, f"Insta API {i}", f"ERR: {str(e)[:30]}",
-                               error=str(e)[:50], username=username, api=api_name,
-                               platform="instagram", duration=api_time)
-                await asyncio.sleep(0.3)
+    session = http_pool.get_session('instagram')
+    # 🔥 1. НОВЫЕ РАБОЧИЕ API 2026 (замена мёртвых)
+    for i, api_base in enumerate(endpoint_health.rank(INSTAGRAM_APIS), 1):
+        api_name = api_base.split('/')[2]
+        api_start = time.time()
+        scraped = False
         
-        # 2️⃣ HTML + JSON parsing (ваш оригинал)
-        await add_to_log(url, "Instagram HTML", "scraping...", username=username, api="HTML Parse", platform="instagram")
         try:
-            async with session.get(url, headers=headers) as resp:
+            await add_to_log(f"Insta API {i}", f"{api_name} | API: {api_name}", api=api_name)
+            
+            api_url = api_base + url
+            async with session.get(api_url, headers=headers) as resp:
                 if resp.status == 200:
-                    html = await resp.text()
+                    content = await resp.text()
                     
-                    # window._sharedData
-                    json_match = re.search(r'window\._sharedData = ({.*?});', html, re.DOTALL)
-                    if json_match:
-                        try:
-                            data = json.loads(json_match.group(1))
-                            entry_data = data.get('entry_data', {}).get('PostPage', [{}])[0]
-                            post_data = entry_data.get('graphql', {}).get('shortcode_media', {})
-                            
-                            # Image
-                            if post_data.get('__typename') == 'GraphImage':
-                                img_url = post_data.get('display_url')
-                                if img_url and 'scontent' in img_url:
-                                    filename = f"downloads/insta_{os.urandom(6).hex()}.jpg"
-                                    file_path = await download_file(img_url, filename, session, headers)
-                                    await add_to_log(url, "JSON Image", "OK", username=username, api="HTML JSON", platform="instagram")
-                                    return file_path, 'image'
-                            
-                            # Video/Reel
-                            elif post_data.get('video_url'):
-                                video_url = post_data.get('video_url')
-                                filename = f"downloads/insta_{os.urandom(6).hex()}.mp4"
-                                file_path = await download_file(video_url, filename, session, headers)
+                    # Современные Reels patterns
+                    patterns = [
+                        r'"(https://[^"\s]+scontent[^"\s]+(?:jpg|jpeg|mp4))"',
+                        r'"download_url":"(https://[^"]+scontent[^"]+(?:jpg|mp4))"',
+                        r'"video_url":"(https://[^"]+scontent[^"]+\.mp4)"',
+                        r'src="(https://[^"\s]+scontent[^"\s]+(?:jpg|mp4))"'
+                    ]
+                    
+                    for pattern in patterns:
+                        match = re.search(pattern, content, re.IGNORECASE)
+                        if match:
+                            media_url = match.group(1).replace('\\\\', '')
+                            if 'scontent' in media_url:
+                                scraped = True
+                                endpoint_health.record_success(api_base, time.time() - api_start)
+                                ext = 'jpg' if any(x in media_url.lower() for x in ['.jpg', '.jpeg']) else 'mp4'
+                                filename = f"downloads/insta_api_{os.urandom(6).hex()}.{ext}"
                                 
-                                # Компрессия
-                                if os.path.getsize(file_path) > 40 * 1024 * 1024:
+                                file_path = await download_file(media_url, filename, headers=headers)
+                                
+                                # Автокомпрессия видео
+                                if ext == 'mp4' and os.path.getsize(file_path) > UPLOAD_LIMIT_MB * 1024 * 1024:
                                     compressed = file_path.replace('.mp4', '_opt.mp4')
                                     if await compress_video_ffmpeg(file_path, compressed):
                                         os.remove(file_path)
                                         file_path = compressed
                                 
-                                await add_to_log(url, "JSON Video", "OK", username=username, api="HTML Video", platform="instagram")
-                                return file_path, 'video'
-                        except:
-                            pass
-                    
-                    # CDN fallback patterns (ваш код)
-                    cdn_patterns = [
-                        r'"display_url":"(https://[^"]+scontent[^"]+(?:jpg|jpeg))"',
-                        r'"video_url":"(https://[^"]+scontent[^"]+\.mp4)"'
-                    ]
-                    for pattern in cdn_patterns:
-                        match = re.search(pattern, html, re.IGNORECASE)
-                        if match and 'scontent' in match.group(1):
-                            media_url = match.group(1)
-                            ext = 'jpg' if '.jpg' in media_url or '.jpeg' in media_url else 'mp4'
-                            filename = f"downloads/insta_{os.urandom(6).hex()}.{ext}"
-                            file_path = await download_file(media_url, filename, session, headers)
-                            await add_to_log(url, "HTML CDN", f"{ext.upper()} OK", username=username, api="HTML CDN", platform="instagram")
-                            return file_path, ext
-                    
-            await add_to_log(url, "HTML parse", "no media", username=username, api="HTML Parse", platform="instagram")
+                                total_time = time.time() - start_time
+                                await add_to_log(f"Insta API {i}", f"{ext.upper()} OK ✓",
+                                               api=api_name, duration=total_time)
+                                return file_path, ext
+            endpoint_health.record_failure(api_base, time.time() - api_start)
         except Exception as e:
-            await add_to_log(url, "HTML fetch", f"ERR: {str(e)[:30]}", username=username, api="HTML Fetch", platform="instagram")
-        
-        # 3️⃣ GraphQL (ваш оригинал)
-        await add_to_log(url, "GraphQL", "trying...", username=username, api="GraphQL", platform="instagram")
-        if shortcode:
-            try:
-                query_hash = "d5d763b1e2acf209d62d22cf2957d710"
-                variables = {"shortcode": shortcode, "child_index": 0, "fetch_comment_count": 3,
-                           "fetch_comment_cursor": "", "fetch_mutual": True}
-                graphql_url = f"https://www.instagram.com/graphql/query/?query_hash={query_hash}&variables={json.dumps(variables)}"
+            api_time = time.time() - api_start
+            if not scraped:
+                endpoint_health.record_failure(api_base, api_time)
+            await add_to_log(f"Insta API {i}", f"ERR: {str(e)[:30]}",
+                           error=str(e)[:50], api=api_name, duration=api_time)
+            await asyncio.sleep(0.3)
+    
+    # 2️⃣ HTML + JSON parsing (ваш оригинал)
+    await add_to_log("Instagram HTML", "scraping...", api="HTML Parse")
+    try:
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 200:
+                html = await resp.text()
                 
-                async with session.get(graphql_url, headers=headers) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        post_data = data.get('data', {}).get('shortcode_media', {})
+                # window._sharedData
+                json_match = re.search(r'window\._sharedData = ({.*?});', html, re.DOTALL)
+                if json_match:
+                    try:
+                        data = json.loads(json_match.group(1))
+                        entry_data = data.get('entry_data', {}).get('PostPage', [{}])[0]
+                        post_data = entry_data.get('graphql', {}).get('shortcode_media', {})
                         
-                        if post_data.get('__typename') == 'GraphImage' and post_data.get('display_url'):
-                            filename = f"downloads/insta_gql_{os.urandom(6).hex()}.jpg"
-                            return await download_file(post_data['display_url'], filename, session, headers), 'image'
+                        # Image
+                        if post_data.get('__typename') == 'GraphImage':
+                            img_url = post_data.get('display_url')
+                            if img_url and 'scontent' in img_url:
+                                filename = f"downloads/insta_{os.urandom(6).hex()}.jpg"
+                                file_path = await download_file(img_url, filename, headers=headers)
+                                await add_to_log("JSON Image", "OK", api="HTML JSON")
+                                return file_path, 'image'
+                        
+                        # Video/Reel
                         elif post_data.get('video_url'):
-                            filename = f"downloads/insta_gql_{os.urandom(6).hex()}.mp4"
-                            file_path = await download_file(post_data['video_url'], filename, session, headers)
+                            video_url = post_data.get('video_url')
+                            filename = f"downloads/insta_{os.urandom(6).hex()}.mp4"
+                            file_path = await download_file(video_url, filename, headers=headers)
+                            
                             # Компрессия
-                            if os.path.getsize(file_path) > 40 * 1024 * 1024:
+                            if os.path.getsize(file_path) > UPLOAD_LIMIT_MB * 1024 * 1024:
                                 compressed = file_path.replace('.mp4', '_opt.mp4')
                                 if await compress_video_ffmpeg(file_path, compressed):
                                     os.remove(file_path)
                                     file_path = compressed
+                            
+                            await add_to_log("JSON Video", "OK", api="HTML Video")
                             return file_path, 'video'
-            except:
-                pass
-        
-        # 4️⃣ oEmbed
-        await add_to_log(url, "oEmbed", "FINAL", username=username, api="oEmbed", platform="instagram")
+                    except:
+                        pass
+                
+                # CDN fallback patterns (ваш код)
+                cdn_patterns = [
+                    r'"display_url":"(https://[^"]+scontent[^"]+(?:jpg|jpeg))"',
+                    r'"video_url":"(https://[^"]+scontent[^"]+\.mp4)"'
+                ]
+                for pattern in cdn_patterns:
+                    match = re.search(pattern, html, re.IGNORECASE)
+                    if match and 'scontent' in match.group(1):
+                        media_url = match.group(1)
+                        ext = 'jpg' if '.jpg' in media_url or '.jpeg' in media_url else 'mp4'
+                        filename = f"downloads/insta_{os.urandom(6).hex()}.{ext}"
+                        file_path = await download_file(media_url, filename, headers=headers)
+                        await add_to_log("HTML CDN", f"{ext.upper()} OK", api="HTML CDN")
+                        return file_path, ext
+                
+        await add_to_log("HTML parse", "no media", api="HTML Parse")
+    except Exception as e:
+        await add_to_log("HTML fetch", f"ERR: {str(e)[:30]}", api="HTML Fetch")
+    
+    # 3️⃣ GraphQL (ваш оригинал)
+    await add_to_log("GraphQL", "trying...", api="GraphQL")
+    if shortcode:
         try:
-            oembed_url = f"https://www.instagram.com/oembed/?url={url}"
-            async with session.get(oembed_url, headers={'User-Agent': headers['User-Agent']}) as resp:
+            query_hash = "d5d763b1e2acf209d62d22cf2957d710"
+            variables = {"shortcode": shortcode, "child_index": 0, "fetch_comment_count": 3,
+                       "fetch_comment_cursor": "", "fetch_mutual": True}
+            graphql_url = f"https://www.instagram.com/graphql/query/?query_hash={query_hash}&variables={json.dumps(variables)}"
+            
+            async with session.get(graphql_url, headers=headers) as resp:
                 if resp.status == 200:
                     data = await resp.json()
-                    if data.get('thumbnail_url'):
-                        filename = f"downloads/insta_oembed_{os.urandom(6).hex()}.jpg"
-                        return await download_file(data['thumbnail_url'], filename, session, headers), 'image'
+                    post_data = data.get('data', {}).get('shortcode_media', {})
+                    
+                    if post_data.get('__typename') == 'GraphImage' and post_data.get('display_url'):
+                        filename = f"downloads/insta_gql_{os.urandom(6).hex()}.jpg"
+                        return await download_file(post_data['display_url'], filename, headers=headers), 'image'
+                    elif post_data.get('video_url'):
+                        filename = f"downloads/insta_gql_{os.urandom(6).hex()}.mp4"
+                        file_path = await download_file(post_data['video_url'], filename, headers=headers)
+                        # Компрессия
+                        if os.path.getsize(file_path) > UPLOAD_LIMIT_MB * 1024 * 1024:
+                            compressed = file_path.replace('.mp4', '_opt.mp4')
+                            if await compress_video_ffmpeg(file_path, compressed):
+                                os.remove(file_path)
+                                file_path = compressed
+                        return file_path, 'video'
         except:
             pass
-        
-        # 🔥🔥 ULTIMATE YT-DLP FALLBACK (СПАСЁТ ВСЁ!)
-        await add_to_log(url, "yt-dlp ULTIMATE", "Instagram FAIL → yt-dlp rescue!", username=username, platform="instagram")
-        try:
-            ydl_opts = {
-                'format': 'best[filesize<50M][height<=720]/best',
-                'outtmpl': f'downloads/instagram_yt_{os.urandom(6).hex()}.%(ext)s',
-                'quiet': True,
-                'extractor_args': {
-                    'youtube': {
-                        'player_client': ['android', 'ios']
-                    }
+    
+    # 4️⃣ oEmbed
+    await add_to_log("oEmbed", "FINAL", api="oEmbed")
+    try:
+        oembed_url = f"https://www.instagram.com/oembed/?url={url}"
+        async with session.get(oembed_url, headers={'User-Agent': headers['User-Agent']}) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                if data.get('thumbnail_url'):
+                    filename = f"downloads/insta_oembed_{os.urandom(6).hex()}.jpg"
+                    return await download_file(data['thumbnail_url'], filename, headers=headers), 'image'
+    except:
+        pass
+    
+    # 🔥🔥 ULTIMATE YT-DLP FALLBACK (СПАСЁТ ВСЁ!)
+    await add_to_log("yt-dlp ULTIMATE", "Instagram FAIL → yt-dlp rescue!")
+    try:
+        ydl_opts = {
+            'format': size_limited_format(),
+            'outtmpl': f'downloads/instagram_yt_{os.urandom(6).hex()}.%(ext)s',
+            'quiet': True,
+            'extractor_args': {
+                'youtube': {
+                    'player_client': ['android', 'ios']
                 }
             }
-            
-            def run_yt_dlp():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    filename = ydl.prepare_filename(info)
-                    # Fix webm
-                    if filename.endswith('.webm'):
-                        subprocess.run(['ffmpeg', '-y', '-i', filename, filename.replace('.webm', '.mp4')], 
-                                     capture_output=True, quiet=True)
-                        filename = filename.replace('.webm', '.mp4')
-                    return filename
-            
-            final_filename = await asyncio.to_thread(run_yt_dlp)
-            
-            # Финальная компрессия
-            if os.path.getsize(final_filename) > 40 * 1024 * 1024:
-                compressed = final_filename.replace('.mp4', '_final.mp4')
-                await compress_video_ffmpeg(final_filename, compressed)
+        }
+        
+        final_filename = await ytdlp_client.download(url, ydl_opts)
+        # Fix webm
+        final_filename = await convert_to_mp4(final_filename)
+        
+        # Финальная компрессия
+        if os.path.getsize(final_filename) > UPLOAD_LIMIT_MB * 1024 * 1024:
+            compressed = final_filename.replace('.mp4', '_final.mp4')
+            if await compress_video_ffmpeg(final_filename, compressed):
                 os.remove(final_filename)
                 final_filename = compressed
-            
-            await add_to_log(url, "YT-DLP Instagram", "RESCUE SUCCESS ✓", username=username, platform="instagram")
-            return final_filename, 'video'
-        
-        except Exception as e:
-            await add_to_log(url, "YT-DLP FAIL", str(e)[:50], username=username, platform="instagram")
         
-        await add_to_log(url, "ERROR", "INSTAGRAMFAIL", username=username)
-        raise Exception("INSTAGRAM_FAIL")
+        await add_to_log("YT-DLP Instagram", "RESCUE SUCCESS ✓")
+        return final_filename, 'video'
+    
+    except Exception as e:
+        await add_to_log("YT-DLP FAIL", str(e)[:50])
+    
+    await add_to_log("Instagram", "ALL FAIL")
+    raise Exception("INSTAGRAM_FAIL")
 
-async def download_youtube(url: str, username: Optional[str] = None) -> Tuple[str, str]:
+async def download_youtube(url: str) -> Tuple[str, str]:
     """YouTube Shorts через yt-dlp (ваш оригинал + улучшения)"""
     os.makedirs('downloads', exist_ok=True)
     start_time = time.time()
     
-    await add_to_log(url, "YouTube", "yt-dlp START", username=username, api="yt-dlp", platform="youtube")
+    await add_to_log("YouTube", "yt-dlp START", api="yt-dlp")
     
     ydl_opts = {
-        'format': 'best[filesize<50M][height<=720]/best',
+        'format': size_limited_format(),
         'outtmpl': f'downloads/youtube_{os.urandom(6).hex()}.%(ext)s',
         'quiet': True,
         'extractor_args': {
@@ -498,63 +825,54 @@ async def download_youtube(url: str, username: Optional[str] = None) -> Tuple[st
     }
     
     try:
-        def run_ydl():
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
-                # Webm → mp4
-                if filename.endswith('.webm'):
-                    subprocess.run(['ffmpeg', '-y', '-i', filename, filename.replace('.webm', '.mp4')], 
-                                 capture_output=True)
-                    return filename.replace('.webm', '.mp4')
-                return filename
-        
-        filename = await asyncio.to_thread(run_ydl)
+        filename = await ytdlp_client.download(url, ydl_opts)
+        # Webm → mp4
+        filename = await convert_to_mp4(filename)
         
         # Компрессия если нужно
-        if os.path.getsize(filename) > 40 * 1024 * 1024:
+        if os.path.getsize(filename) > UPLOAD_LIMIT_MB * 1024 * 1024:
             compressed = filename.replace('.mp4', '_opt.mp4')
             if await compress_video_ffmpeg(filename, compressed):
                 os.remove(filename)
                 filename = compressed
         
         total_time = time.time() - start_time
-        await add_to_log(url, "YouTube", f"OK {os.path.getsize(filename)/(1024*1024):.1f}MB", 
-                        username=username, api="yt-dlp", platform="youtube", duration=total_time)
+        await add_to_log("YouTube", f"OK {os.path.getsize(filename)/(1024*1024):.1f}MB", 
+                        api="yt-dlp", duration=total_time)
         return filename, 'video'
     
     except Exception as e:
         total_time = time.time() - start_time
-        await add_to_log(url, "YouTube FAIL", str(e)[:30], username=username, api="yt-dlp", platform="youtube")
+        await add_to_log("YouTube FAIL", str(e)[:30], api="yt-dlp")
         raise Exception("YOUTUBE_FAIL")
 
-async def download_video(url: str, platform: str, username: Optional[str] = None) -> Tuple[Union[str, Dict], str, str]:
+async def download_video(url: str, platform: str) -> Tuple[Union[str, Dict], str, str]:
     """Главная точка входа (роутинг + полный fallback)"""
-    await add_to_log(url, platform.upper(), "START", username=username, platform=platform)
+    await add_to_log(platform.upper(), "START")
     
     try:
         if platform == 'tiktok':
-            filename, media_type = await download_tiktok(url, username)
+            filename, media_type = await download_tiktok(url)
             return filename, 'TikTok', media_type
         elif platform == 'instagram':
             try:
-                filename, media_type = await download_instagram(url, username)
+                filename, media_type = await download_instagram(url)
                 return filename, 'Instagram', media_type
             except Exception as e:
                 if "INSTAGRAM_FAIL" in str(e):
-                    logger.warning(f"Instagram ALL FAIL → ULTIMATE yt-dlp для {username}")
+                    logger.warning("Instagram ALL FAIL → ULTIMATE yt-dlp")
                     try:
-                        filename, media_type = await download_youtube(url, username)  # Используем youtube func как universal
+                        filename, media_type = await download_youtube(url)  # Используем youtube func как universal
                         return filename, 'Instagram(yt-dlp)', media_type
                     except Exception as yt_error:
                          logger.error(f"Instagram fallback via YouTube failed: {yt_error}")
                          raise Exception(f"INSTAGRAM_FAIL_FINAL: {yt_error}") # Re-raise as Instagram error with details
                 raise
         elif platform == 'youtube':
-            filename, media_type = await download_youtube(url, username)
+            filename, media_type = await download_youtube(url)
             return filename, 'Youtube', media_type
         else:
             raise ValueError(f"Unknown platform: {platform}")
     except Exception as e:
-        await add_to_log(url, "ERROR", str(e), username=username, platform=platform)
+        await add_to_log("DOWNLOAD FAIL", str(e))
         raise
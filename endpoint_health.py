@@ -0,0 +1,158 @@
+import logging
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from urllib.parse import urlsplit
+
+import metrics
+from config import (
+    BREAKER_COOLDOWN,
+    BREAKER_FAILURE_THRESHOLD,
+    ENDPOINT_DEFAULT_LATENCY,
+    ENDPOINT_EWMA_ALPHA,
+    ENDPOINT_HEALTH_FILE,
+)
+from json_store import JsonFile
+
+logger = logging.getLogger(__name__)
+
+# Минимальная пауза между записями файла состояния
+SAVE_INTERVAL = 30
+
+
+@dataclass
+class EndpointStats:
+    latency: Optional[float] = None   # EWMA латентности, с
+    success_rate: float = 1.0         # EWMA успешности (0..1)
+    failures_in_row: int = 0
+    last_failure: float = 0.0
+    opened_at: float = 0.0            # 0 → breaker закрыт
+    requests: int = 0
+    successes: int = 0
+
+    @property
+    def state(self) -> str:
+        if not self.opened_at:
+            return "closed"
+        if time.time() - self.opened_at >= BREAKER_COOLDOWN:
+            return "half-open"
+        return "open"
+
+    @property
+    def cost(self) -> float:
+        """Ожидаемая «цена» запроса: латентность / вероятность успеха."""
+        latency = self.latency if self.latency is not None else ENDPOINT_DEFAULT_LATENCY
+        return latency / max(self.success_rate, 0.05)
+
+
+_endpoints: Dict[str, EndpointStats] = {}
+_store = JsonFile(ENDPOINT_HEALTH_FILE, SAVE_INTERVAL, indent=2)
+
+
+def get_stats(endpoint: str) -> EndpointStats:
+    if endpoint not in _endpoints:
+        _endpoints[endpoint] = EndpointStats()
+    return _endpoints[endpoint]
+
+
+def rank(endpoints: List[str]) -> List[str]:
+    """
+    Порядок опроса endpoint'ов для одного запроса.
+
+    Одна half-open проба – первой: так запрос к ней точно уйдёт (опрос Instagram
+    останавливается на первом успехе, гонка TikTok отменяет опоздавших), и только
+    её отсчёт cooldown сдвигается. Затем закрытые по возрастанию «цены», остальные
+    half-open – в конце, не расходуясь. Открытые не опрашиваются вовсе; только если
+    живых нет совсем, пробуем хоть их.
+    """
+    closed, probes, opened = [], [], []
+    for endpoint in endpoints:
+        state = get_stats(endpoint).state
+        if state == "closed":
+            closed.append(endpoint)
+        elif state == "half-open":
+            probes.append(endpoint)
+        else:
+            opened.append(endpoint)
+
+    closed.sort(key=lambda e: get_stats(e).cost)
+    opened.sort(key=lambda e: get_stats(e).opened_at)
+    if not probes:
+        return closed or opened
+
+    # Half-open: одна проба за период cooldown — сдвигаем отсчёт заново
+    probes.sort(key=lambda e: get_stats(e).opened_at)
+    probe, rest = probes[0], probes[1:]
+    get_stats(probe).opened_at = time.time()
+    return [probe] + closed + rest
+
+
+def _update(endpoint: str, ok: bool, latency: Optional[float]) -> None:
+    stats = get_stats(endpoint)
+    alpha = ENDPOINT_EWMA_ALPHA
+    stats.requests += 1
+    stats.success_rate = (1 - alpha) * stats.success_rate + alpha * (1.0 if ok else 0.0)
+    if latency is not None:
+        stats.latency = latency if stats.latency is None else (1 - alpha) * stats.latency + alpha * latency
+        metrics.observe("api_request_seconds", latency, api=urlsplit(endpoint).netloc or endpoint,
+                        result="ok" if ok else "error")
+
+    if ok:
+        stats.successes += 1
+        stats.failures_in_row = 0
+        stats.opened_at = 0.0
+    else:
+        stats.failures_in_row += 1
+        stats.last_failure = time.time()
+        if stats.failures_in_row >= BREAKER_FAILURE_THRESHOLD:
+            if not stats.opened_at:
+                logger.warning("🔌 Circuit breaker OPEN: %s", endpoint)
+            stats.opened_at = time.time()
+
+    if _store.due():
+        save()
+
+
+def record_success(endpoint: str, latency: Optional[float] = None) -> None:
+    _update(endpoint, True, latency)
+
+
+def record_failure(endpoint: str, latency: Optional[float] = None) -> None:
+    _update(endpoint, False, latency)
+
+
+def load() -> None:
+    """Загрузка состояния с диска (переживает рестарт)."""
+    data = _store.load() or {}
+    for endpoint, values in data.items():
+        try:
+            _endpoints[endpoint] = EndpointStats(**values)
+        except TypeError as e:
+            logger.error(f"Failed to load endpoint health for {endpoint}: {e}")
+
+
+def save() -> None:
+    _store.save({e: asdict(s) for e, s in _endpoints.items()})
+
+
+def rank_preview(endpoints: List[str]) -> List[str]:
+    """Текущий порядок без побочных эффектов (half-open не расходуется)."""
+    order = {"closed": 0, "half-open": 1, "open": 2}
+    return sorted(endpoints, key=lambda e: (order[get_stats(e).state], get_stats(e).cost))
+
+
+def get_health_report(endpoints: List[str]) -> str:
+    """Текстовая сводка по endpoint'ам (для команды /apis)."""
+    state_icons = {"closed": "🟢", "half-open": "🟡", "open": "🔴"}
+    lines = []
+    for endpoint in rank_preview(endpoints):
+        stats = get_stats(endpoint)
+        name = endpoint.split('/')[2] if '/' in endpoint else endpoint[:30]
+        line = f"{state_icons[stats.state]} {name}: {stats.successes}/{stats.requests} OK, EWMA {stats.success_rate * 100:.0f}%"
+        if stats.latency is not None:
+            line += f", {stats.latency:.2f}s"
+        if stats.last_failure:
+            line += f", fail {int(time.time() - stats.last_failure)}s ago"
+        lines.append(line)
+    return "\n".join(lines)
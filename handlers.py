@@ -1,24 +1,32 @@
-import asyncio
+import functools
 import logging
-from typing import List, Tuple, Dict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
 import time
 
 # Buffer for merging split messages (text + link)
 # Buffer for merging split messages (text + link, message_id)
 last_user_text: Dict[int, Tuple[str, float, int]] = {}
-# Buffer for locking link processing to wait for text (link then text)
-link_waiting_for_text: set = set()
-captured_caption_updates: Dict[int, str] = {}
+# Caption window per chat: text after a link (link then text) goes to the link's job
+caption_windows: Dict[int, 'CaptionWindow'] = {}
 
 from aiogram import F, types
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 
 from bot import bot, dp
-from config import url_patterns
+from config import ADMIN_IDS, CAPTION_WAIT, INSTAGRAM_APIS, LOG_ENTRIES_PER_URL, TIKTOK_APIS, url_patterns
 from tasks import process_video_task
 from tasks import process_video_task
-from utils import add_to_log, download_log, format_log_entry, safe_send_message, safe_delete_message
+from utils import CaptionWindow, add_to_log, canonical_url, delete_later, download_log, format_log_entry, safe_send_message
+import endpoint_health
+import history
+import loop_monitor
+import metrics
+import rate_limiter
+import scheduler
 import stats
+import tracing
+import ytdlp_client
 
 logger = logging.getLogger(__name__)
 
@@ -29,10 +37,27 @@ async def handle_reaction(event: types.MessageReactionUpdated):
     await stats.handle_reaction(event)
 
 
+# /stats <период>: заголовок и длина окна в секундах
+STATS_WINDOWS = {
+    '24h': ("За 24 часа", 24 * 3600),
+    'week': ("За неделю", 7 * 24 * 3600),
+    'month': ("За месяц", 30 * 24 * 3600),
+}
+
+
 @dp.message(Command("stats"))
-async def cmd_stats(message: types.Message):
-    """Показать статистику по реакциям"""
-    text = stats.get_stats_report()
+async def cmd_stats(message: types.Message, command: CommandObject):
+    """
+    Показать статистику по реакциям.
+    /stats chat – топ только этого чата; /stats 24h|week|month [chat] – за период.
+    """
+    args = (command.args or "").split()
+    chat_id = message.chat.id if "chat" in args else None
+    period = next((STATS_WINDOWS[a] for a in args if a in STATS_WINDOWS), None)
+    if period:
+        text = stats.get_window_report(*period, chat_id=chat_id)
+    else:
+        text = stats.get_stats_report(chat_id)
     await message.answer(text, parse_mode="HTML")
 
 
@@ -45,6 +70,68 @@ async def cmd_set_report_chat(message: types.Message):
 
 
 
+@dp.message(Command("apis"))
+async def cmd_apis(message: types.Message) -> None:
+    """Показать здоровье TikTok / Instagram API (circuit breaker, EWMA)"""
+    text = (
+        "🔌 TikTok API:\n" + endpoint_health.get_health_report(TIKTOK_APIS)
+        + "\n\n🔌 Instagram API:\n" + endpoint_health.get_health_report(INSTAGRAM_APIS)
+    )
+    pool = ytdlp_client.queue_stats()
+    text += f"\n\n🎞 yt-dlp ({pool['backend']} × {pool['workers']}): работает {pool['running']}, в очереди {pool['queued']}"
+    jobs = scheduler.queue_stats()
+    text += f"\n🚦 Загрузки: работает {jobs['running']}, в очереди {jobs['queued']}"
+    outbound = rate_limiter.queue_stats()
+    text += f"\n📤 Bot API: ждут отправки {outbound['waiting_sends']}, 429 всего {outbound['throttled']}"
+    await safe_send_message(message.chat.id, text)
+
+
+@dp.message(Command("perf"))
+async def cmd_perf(message: types.Message) -> None:
+    """p50/p95 по этапам (resolve/download/compress/upload), API и задачам, объёмы, очереди"""
+    await safe_send_message(message.chat.id, metrics.get_perf_report())
+
+
+@dp.message(Command("profile"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_profile(message: types.Message, command: CommandObject) -> None:
+    """Сэмплирующий профайлер на N секунд (только ADMIN_IDS): /profile 10"""
+    arg = (command.args or "").strip()
+    seconds = float(arg) if arg.replace('.', '', 1).isdigit() else 10
+    await safe_send_message(message.chat.id, f"🔬 Профилирую {seconds:g}s...")
+    await safe_send_message(message.chat.id, (await loop_monitor.profile(seconds))[:4000])
+
+
+@dp.message(Command("stalls"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_stalls(message: types.Message) -> None:
+    """Последние зависания цикла событий со стеком (только ADMIN_IDS)"""
+    await safe_send_message(message.chat.id, loop_monitor.get_stalls_report()[:4000])
+
+
+@dp.message(Command("trace"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_trace(message: types.Message, command: CommandObject) -> None:
+    """
+    Трасса задачи (только ADMIN_IDS): /trace – последняя, /trace <job_id> – конкретная,
+    /trace [job_id] folded – файл свёрнутых стеков для flamegraph.pl / speedscope.
+    """
+    args = (command.args or "").split()
+    folded = "folded" in args
+    args = [arg for arg in args if arg != "folded"]
+    if args:
+        trace = tracing.recent_traces.get(args[0])
+    else:
+        trace = next(reversed(tracing.recent_traces.values()), None)
+    if trace is None:
+        recent = ", ".join(list(tracing.recent_traces)[-5:]) or "пока нет"
+        await message.answer(f"❌ Трасса не найдена. Последние задачи: {recent}", parse_mode=None)
+        return
+    if folded:
+        data = tracing.export_folded(trace).encode()
+        await message.answer_document(types.BufferedInputFile(data, filename=f"trace_{trace.job_id}.folded"))
+        return
+    # Без safe_send_message: он вырезает «_», а он есть в job_id
+    await message.answer(tracing.format_trace(trace)[:4000], parse_mode=None)
+
+
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message) -> None:
     await message.answer(
@@ -52,30 +139,89 @@ async def cmd_start(message: types.Message) -> None:
         "✅ TikTok видео\n"
         "✅ Instagram HTML parse\n"
         "✅ YouTube Shorts\n\n"
-        "log ссылка | logs | start",
+        "log ссылка | logs [фильтры] | apis | perf | start",
         parse_mode=None,
     )
 
 
+# /logs <фильтры>: единицы для периодов вида 30m / 2h / 7d
+HISTORY_PERIOD_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+HISTORY_HELP = (
+    "/logs [tiktok|instagram|youtube] [failed|ok] [slow] [30m|2h|7d|today] [@user] [api=имя]\n"
+    "Например: /logs tiktok failed 1h, /logs slow today"
+)
+
+
+def parse_history_filters(args: List[str]) -> Optional[Dict[str, Any]]:
+    """Аргументы /logs → фильтры history.query (None – непонятный аргумент)."""
+    filters: Dict[str, Any] = {}
+    for arg in args:
+        low = arg.lower()
+        if low in url_patterns:
+            filters['platform'] = low
+        elif low in ('failed', 'fail', 'errors'):
+            filters['failed'] = True
+        elif low == 'ok':
+            filters['failed'] = False
+        elif low in ('slow', 'slowest'):
+            filters['slowest'] = True
+        elif low == 'today':
+            midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            filters['since'] = midnight.timestamp()
+        elif low[:-1].isdigit() and low[-1:] in HISTORY_PERIOD_UNITS:
+            filters['since'] = time.time() - int(low[:-1]) * HISTORY_PERIOD_UNITS[low[-1]]
+        elif arg.startswith('@') and len(arg) > 1:
+            filters['username'] = arg[1:]
+        elif low.startswith('api=') and len(arg) > 4:
+            filters['api'] = arg[4:]
+        else:
+            return None
+    return filters
+
+
+async def send_history(chat_id: int, args: List[str]) -> None:
+    """Ответ на /logs с фильтрами: выборка из истории загрузок на диске."""
+    filters = parse_history_filters(args)
+    if filters is None:
+        await safe_send_message(chat_id, HISTORY_HELP)
+        return
+
+    rows = history.query(**filters)
+    if not rows:
+        await safe_send_message(chat_id, f"Ничего не найдено: {' '.join(args)}")
+        return
+
+    log_text = f"🔍 ИСТОРИЯ ({' '.join(args)}): {len(rows)}\n" + "=" * 50 + "\n\n"
+    for url, entry in rows:
+        log_text += f"{entry.date} {format_log_entry(entry)}\n🔗 {url[:60]}\n\n"
+
+    for i in range(0, len(log_text), 3800):
+        await safe_send_message(chat_id, log_text[i:i + 3800])
+
+
 @dp.message(Command("logs"))
-async def cmd_logs(message: types.Message) -> None:
-    """Показать последние 3 загрузки с детальной информацией."""
+async def cmd_logs(message: types.Message, command: CommandObject) -> None:
+    """Показать последние 3 загрузки с детальной информацией (с аргументами – поиск по истории)."""
+    if command.args:
+        await send_history(message.chat.id, command.args.split())
+        return
+
     if not download_log:
         await message.answer("Логов нет")
         return
 
     log_text = "🔍 ПОСЛЕДНИЕ 3 ЗАГРУЗКИ:\n" + "=" * 50 + "\n\n"
     
-    for url in list(download_log.keys())[-3:]:
-        entries = download_log[url]
+    for url, url_log in download_log.recent(3):
+        entries = list(url_log.entries)
         if not entries:
             continue
             
         # Получаем метаданные из первой записи
         first_entry = entries[0]
-        username = first_entry.get('username', 'unknown')
-        platform = first_entry.get('platform', '').upper()
-        total_duration = entries[-1].get('duration')
+        username = first_entry.username or 'unknown'
+        platform = first_entry.platform.upper()
+        total_duration = entries[-1].duration
         
         log_text += f"🔗 URL: {url[:60]}\n"
         log_text += f"👤 Пользователь: @{username}\n"
@@ -118,11 +264,16 @@ async def cmd_log(message: types.Message) -> None:
         return
 
     url = urls[0]
-    if url not in download_log:
+    url_log = download_log.get(url)
+    if url_log is not None:
+        entries = list(url_log.entries)
+    else:
+        # Нет в памяти (другая форма ссылки или был перезапуск) → история на диске
+        entries = [entry for _, entry in reversed(history.query(url=canonical_url(url), limit=LOG_ENTRIES_PER_URL))]
+    if url_log is None and not entries:
         await safe_send_message(message.chat.id, f"❌ Лог не найден: {url[:50]}\nИспользуйте /logs для просмотра всех логов")
         return
 
-    entries = download_log[url]
     if not entries:
         await safe_send_message(message.chat.id, f"❌ Лог пуст для: {url[:50]}")
         return
@@ -130,12 +281,12 @@ async def cmd_log(message: types.Message) -> None:
     # Собираем статистику
     first_entry = entries[0]
     last_entry = entries[-1]
-    username = first_entry.get('username', 'unknown')
-    platform = first_entry.get('platform', '').upper()
-    total_duration = last_entry.get('duration')
+    username = first_entry.username or 'unknown'
+    platform = first_entry.platform.upper()
+    total_duration = last_entry.duration
     
     # Подсчитываем использованные API
-    used_apis = {entry['api'][:40] for entry in entries if entry.get('api')}
+    used_apis = {entry.api[:40] for entry in entries if entry.api}
     
     # Формируем детальный лог
     log_text = "=" * 50 + "\n"
@@ -179,10 +330,11 @@ async def handle_message(message: types.Message) -> None:
 
     if not urls:
         # Check if a link is waiting for text
-        if message.chat.id in link_waiting_for_text:
-             captured_caption_updates[message.chat.id] = text
+        window = caption_windows.get(message.chat.id)
+        if window is not None and window.is_open:
+             window.add(text)
              logger.info("Captured text for waiting link: %s", text[:20])
-             await safe_delete_message(message.chat.id, message.message_id) # Delete text message
+             delete_later(message.chat.id, message.message_id) # Delete text message
              return
 
         # Buffer text for potential merge (keep for 2 seconds)
@@ -207,70 +359,45 @@ async def handle_message(message: types.Message) -> None:
             else:
                 user_caption = cached_text
             logger.info("Merged previous text message with link for @%s", username)
-            await safe_delete_message(message.chat.id, cached_msg_id) # Delete text message
+            delete_later(message.chat.id, cached_msg_id) # Delete text message
         # Clear buffer
         del last_user_text[message.chat.id]
 
+    # Register caption window synchronously BEFORE await calls to prevent race.
+    # This ensures that if prompt text arrives while we are sending "processing...", it is caught.
+    # The download starts right away; the caption is merged at send time.
+    window = CaptionWindow(CAPTION_WAIT)
+    caption_windows[message.chat.id] = window
+
     for url, platform in urls:
-        # 1. Register waiting synchronously BEFORE await calls to prevent race
-        # This ensures that if prompt text arrives while we are sending "processing...", it is caught.
-        link_waiting_for_text.add(message.chat.id)
-        
-        processing_msg = await bot.send_message(
+        processing_text = f"⏳ {username}, {platform}..."
+        processing_msg = await bot.send_message(message.chat.id, processing_text)
+
+        job = functools.partial(
+            process_video_task,
+            message.message_id,
             message.chat.id,
-            f"⏳ {username}, {platform}...",
+            processing_msg.message_id,
+            url,
+            username,
+            platform,
+            user_caption=user_caption,
+            caption_window=window,
         )
-        asyncio.create_task(
-            process_video_task_delayed(
-                message.message_id,
-                message.chat.id,
-                processing_msg.message_id,
-                url,
-                username,
-                platform,
-                user_caption=user_caption,
-            )
+        show_position = functools.partial(
+            show_queue_position, message.chat.id, processing_msg.message_id, processing_text,
         )
+        accepted = await scheduler.submit(
+            message.chat.id, message.from_user.id, platform, job, on_position=show_position,
+        )
+        if not accepted:
+            await bot.edit_message_text(
+                f"🚦 {username}, очередь переполнена — попробуйте позже",
+                chat_id=message.chat.id, message_id=processing_msg.message_id,
+            )
 
 
-async def process_video_task_delayed(
-    message_id: int,
-    chat_id: int,
-    processing_msg_id: int,
-    url: str,
-    username: str,
-    platform: str,
-    user_caption: str = "",
-) -> None:
-    """Wrapper to wait for potential text message (Link then Text scenario)"""
-    
-    # 1. Register waiting (Already done synchronously in handler, but reinforce here is fine)
-    link_waiting_for_text.add(chat_id)
-    
-    # 2. Waitshortly for validation
-    await asyncio.sleep(1.5)
-    
-    # 3. Stop waiting
-    if chat_id in link_waiting_for_text:
-        link_waiting_for_text.remove(chat_id)
-        
-    # 4. Check if text was captured
-    if chat_id in captured_caption_updates:
-        new_text = captured_caption_updates.pop(chat_id)
-        if user_caption:
-             user_caption = f"{user_caption}\n{new_text}"
-        else:
-             user_caption = new_text
-        logger.info("Merged waiting text to link: %s", new_text[:20])
-
-    # 5. Run original task
-    await process_video_task(
-        message_id,
-        chat_id,
-        processing_msg_id,
-        url,
-        username,
-        platform,
-        user_caption,
-    )
-
+async def show_queue_position(chat_id: int, processing_msg_id: int, processing_text: str, position: int) -> None:
+    """Номер в очереди планировщика — в сообщении «⏳ обработка» (0 → задача запущена)."""
+    text = f"{processing_text} в очереди: {position}" if position else processing_text
+    await bot.edit_message_text(text, chat_id=chat_id, message_id=processing_msg_id)
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from typing import Any, List, Optional, Tuple
+
+from config import HISTORY_DB, HISTORY_FLUSH_EVENTS, HISTORY_FLUSH_INTERVAL, HISTORY_KEEP_DAYS
+from log_store import LogEntry
+
+logger = logging.getLogger(__name__)
+
+# Неудачная загрузка – итог задачи из tasks.py: ERROR или TELEGRAM_TOO_LARGE (в логе без «_»).
+# Ошибки промежуточных шагов (API, FFmpeg, fallback) – не итог: задача могла закончиться успехом.
+FAILED_ACTIONS = ("ERROR", "TELEGRAMTOOLARGE")
+
+# Как часто чистить записи старше HISTORY_KEEP_DAYS
+PRUNE_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id       INTEGER PRIMARY KEY,
+    ts       REAL NOT NULL,
+    url      TEXT NOT NULL,      -- каноническая ссылка
+    action   TEXT NOT NULL,
+    status   TEXT NOT NULL,
+    username TEXT NOT NULL,
+    api      TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    duration REAL,
+    error    TEXT NOT NULL,
+    failed   INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+CREATE INDEX IF NOT EXISTS events_url ON events (url, ts);
+CREATE INDEX IF NOT EXISTS events_user ON events (username, ts);
+CREATE INDEX IF NOT EXISTS events_platform ON events (platform, failed, ts);
+CREATE INDEX IF NOT EXISTS events_api_lower ON events (lower(api), ts);
+CREATE INDEX IF NOT EXISTS events_duration ON events (duration) WHERE duration IS NOT NULL;
+"""
+
+_db: Optional[sqlite3.Connection] = None
+
+# Записи, ещё не попавшие в базу (пишутся пачками, только добавлением)
+_pending: List[Tuple[Any, ...]] = []
+_flush_task: Optional[asyncio.Task] = None
+_last_prune = 0.0
+
+
+def get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(HISTORY_DB, isolation_level=None)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.executescript(SCHEMA)
+    return _db
+
+
+def is_failed(entry: LogEntry) -> bool:
+    return entry.action.upper().replace("_", "") in FAILED_ACTIONS
+
+
+def record(url: str, entry: LogEntry) -> None:
+    """Поставить запись в очередь на запись (url – каноническая ссылка)."""
+    global _flush_task
+    _pending.append((
+        entry.time, url, entry.action, entry.status, entry.username, entry.api,
+        entry.platform, entry.duration, entry.error, int(is_failed(entry)),
+    ))
+    if len(_pending) >= HISTORY_FLUSH_EVENTS:
+        flush()
+    elif _flush_task is None:
+        try:
+            _flush_task = asyncio.get_running_loop().create_task(_flush_later())
+        except RuntimeError:
+            flush()  # нет цикла событий – пишем сразу
+
+
+async def _flush_later() -> None:
+    global _flush_task
+    try:
+        await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+    finally:
+        _flush_task = None
+    flush()
+
+
+def flush() -> None:
+    """Дописать накопленные записи одной транзакцией; заодно раз в час чистим старые."""
+    global _last_prune
+    if not _pending:
+        return
+    db = get_db()
+    batch = _pending[:]
+    _pending.clear()
+    now = time.time()
+    with db:
+        db.execute("BEGIN")
+        db.executemany(
+            "INSERT INTO events (ts, url, action, status, username, api, platform, duration, error, failed) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            batch,
+        )
+        if now - _last_prune >= PRUNE_INTERVAL:
+            _last_prune = now
+            db.execute("DELETE FROM events WHERE ts < ?", (now - HISTORY_KEEP_DAYS * 86400,))
+
+
+def close() -> None:
+    global _db
+    flush()
+    if _db is not None:
+        _db.close()
+        _db = None
+
+
+def query(
+    url: Optional[str] = None,
+    username: Optional[str] = None,
+    platform: Optional[str] = None,
+    api: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    failed: Optional[bool] = None,
+    slowest: bool = False,
+    limit: int = 20,
+) -> List[Tuple[str, LogEntry]]:
+    """
+    Записи истории по фильтрам: [(url, запись)], новые первыми
+    (slowest=True – самые долгие загрузки первыми). Все фильтры идут по индексам.
+    """
+    flush()
+    where, params = [], []
+    for column, value in (("url", url), ("username", username), ("platform", platform)):
+        if value is not None:
+            where.append(f"{column} = ?")
+            params.append(value)
+    if api is not None:
+        # Префикс без учёта регистра – диапазоном по индексу на lower(api)
+        prefix = api.lower()
+        where.append("lower(api) >= ? AND lower(api) < ?")
+        params += [prefix, prefix + "\U0010ffff"]
+    if since is not None:
+        where.append("ts >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("ts < ?")
+        params.append(until)
+    if failed is not None:
+        where.append("failed = ?")
+        params.append(int(failed))
+    if slowest:
+        where.append("duration IS NOT NULL")
+
+    # slowest: по одной (самой долгой) записи на ссылку – это длительность всей загрузки
+    duration_column = "MAX(duration)" if slowest else "duration"
+    sql = f"SELECT ts, url, action, status, username, api, platform, {duration_column}, error FROM events"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " GROUP BY url ORDER BY 8 DESC" if slowest else " ORDER BY ts DESC"
+    sql += " LIMIT ?"
+    params.append(limit)
+
+    rows = []
+    for ts, event_url, action, status, user, event_api, event_platform, duration, error in get_db().execute(sql, params):
+        entry = LogEntry(action, status, user, event_api, event_platform, duration, error, ts=ts)
+        rows.append((event_url, entry))
+    return rows
@@ -0,0 +1,55 @@
+import logging
+from typing import Dict
+
+import aiohttp
+
+from config import HTTP_DNS_CACHE_TTL, HTTP_HOST_GROUPS, HTTP_KEEPALIVE_TIMEOUT, HTTP_POOL_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Одна долгоживущая сессия на группу хостов: keep-alive + DNS-кэш,
+# чтобы не платить DNS/TCP/TLS за каждую ссылку.
+_sessions: Dict[str, aiohttp.ClientSession] = {}
+
+
+def _create_session(group: str) -> aiohttp.ClientSession:
+    settings = HTTP_HOST_GROUPS.get(group, HTTP_HOST_GROUPS['media'])
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=settings['limit_per_host'],
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        enable_cleanup_closed=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=settings['timeout']),
+    )
+
+
+def get_session(group: str = 'media') -> aiohttp.ClientSession:
+    """Общая сессия для группы хостов (создаётся лениво при первом обращении)."""
+    session = _sessions.get(group)
+    if session is None or session.closed:
+        session = _create_session(group)
+        _sessions[group] = session
+    return session
+
+
+async def startup() -> None:
+    """Создаём сессии заранее, при запуске бота."""
+    for group in HTTP_HOST_GROUPS:
+        get_session(group)
+    logger.info("🌐 HTTP pool started: %s", ", ".join(HTTP_HOST_GROUPS))
+
+
+async def shutdown() -> None:
+    """Закрываем все сессии (вызывается при остановке бота)."""
+    for group, session in list(_sessions.items()):
+        try:
+            await session.close()
+        except Exception as e:
+            logger.error("Failed to close HTTP session %s: %s", group, e)
+    _sessions.clear()
+    logger.info("🌐 HTTP pool closed")
@@ -0,0 +1,45 @@
+import json
+import logging
+import os
+import time
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class JsonFile:
+    """
+    Небольшое состояние в JSON-файле: атомарная запись через .tmp + os.replace
+    и запись не чаще раза в min_interval секунд (save_throttled).
+    """
+
+    def __init__(self, path: str, min_interval: float = 30, **dump_kwargs: Any):
+        self.path = path
+        self.min_interval = min_interval
+        self.dump_kwargs = dump_kwargs
+        self.last_save = 0.0
+
+    def load(self) -> Optional[Any]:
+        """Содержимое файла; None – если файла нет или он битый."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load {self.path}: {e}")
+            return None
+
+    def save(self, data: Any) -> None:
+        self.last_save = time.time()
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, **self.dump_kwargs)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Failed to save {self.path}: {e}")
+
+    def due(self) -> bool:
+        """Прошло ли min_interval с последней записи."""
+        return time.time() - self.last_save >= self.min_interval
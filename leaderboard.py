@@ -0,0 +1,64 @@
+import bisect
+from typing import Dict, Generic, Hashable, List, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+
+
+class Leaderboard(Generic[K]):
+    """
+    Рейтинг ключей по счётчику, который обновляется по мере изменения счётчиков.
+
+    Ключи разложены по корзинам с одинаковым значением, список различных
+    значений отсортирован. top(k) идёт от большей корзины к меньшей и
+    останавливается на k-м ключе – O(k), без сортировки всех ключей.
+    При равенстве первым идёт ключ, раньше набравший это значение.
+    """
+
+    def __init__(self):
+        self.scores: Dict[K, int] = {}
+        self._buckets: Dict[int, Dict[K, None]] = {}  # значение → ключи (в порядке прихода)
+        self._values: List[int] = []                  # различные значения > 0, по возрастанию
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def _unlink(self, key: K, score: int) -> None:
+        bucket = self._buckets[score]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[score]
+            del self._values[bisect.bisect_left(self._values, score)]
+
+    def set(self, key: K, score: int) -> None:
+        """Новое значение счётчика; 0 и меньше – ключ выпадает из рейтинга."""
+        old = self.scores.get(key, 0)
+        if old == score:
+            return
+        if old > 0:
+            self._unlink(key, old)
+        if score > 0:
+            self.scores[key] = score
+            bucket = self._buckets.get(score)
+            if bucket is None:
+                bucket = self._buckets[score] = {}
+                bisect.insort(self._values, score)
+            bucket[key] = None
+        else:
+            self.scores.pop(key, None)
+
+    def add(self, key: K, delta: int) -> int:
+        score = max(0, self.scores.get(key, 0) + delta)
+        self.set(key, score)
+        return score
+
+    def remove(self, key: K) -> None:
+        self.set(key, 0)
+
+    def top(self, k: int) -> List[Tuple[K, int]]:
+        result: List[Tuple[K, int]] = []
+        for score in reversed(self._values):
+            for key in self._buckets[score]:
+                if len(result) >= k:
+                    return result
+                result.append((key, score))
+        return result
@@ -0,0 +1,90 @@
+import sys
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Deque, List, Optional, Tuple
+
+
+class LogEntry:
+    """Одна запись лога загрузки. __slots__ вместо dict: без словаря на каждую запись."""
+
+    __slots__ = ("time", "action", "status", "username", "api", "platform", "duration", "error")
+
+    def __init__(self, action: str, status: str, username: str, api: str, platform: str,
+                 duration: Optional[float], error: str, ts: Optional[float] = None):
+        self.time = time.time() if ts is None else ts
+        # Действия, API, платформы и ники повторяются из записи в запись → одна копия строки
+        self.action = sys.intern(action)
+        self.status = status
+        self.username = sys.intern(username)
+        self.api = sys.intern(api)
+        self.platform = sys.intern(platform)
+        self.duration = duration
+        self.error = error
+
+    @property
+    def timestamp(self) -> str:
+        return datetime.fromtimestamp(self.time).strftime("%H:%M:%S")
+
+    @property
+    def date(self) -> str:
+        return datetime.fromtimestamp(self.time).strftime("%d.%m")
+
+
+class UrlLog:
+    """Лог одной ссылки: кольцевой буфер последних записей + время начала загрузки."""
+
+    __slots__ = ("entries", "started_at")
+
+    def __init__(self, max_entries: int):
+        self.entries: Deque[LogEntry] = deque(maxlen=max_entries)
+        self.started_at: Optional[float] = None
+
+
+class DownloadLog:
+    """
+    Ограниченный лог загрузок: LRU по ссылкам (не больше max_urls),
+    у каждой ссылки – не больше max_entries последних записей.
+    """
+
+    def __init__(self, max_urls: int, max_entries: int):
+        self.max_urls = max_urls
+        self.max_entries = max_entries
+        self._urls: "OrderedDict[str, UrlLog]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._urls)
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._urls
+
+    def get(self, url: str) -> Optional[UrlLog]:
+        return self._urls.get(url)
+
+    def _touch(self, url: str) -> UrlLog:
+        log = self._urls.get(url)
+        if log is None:
+            log = self._urls[url] = UrlLog(self.max_entries)
+            while len(self._urls) > self.max_urls:
+                self._urls.popitem(last=False)
+        else:
+            self._urls.move_to_end(url)
+        return log
+
+    def start(self, url: str) -> None:
+        """Новая загрузка ссылки: время отсчитывается заново."""
+        self._touch(url).started_at = time.time()
+
+    def elapsed(self, url: str) -> Optional[float]:
+        log = self._urls.get(url)
+        if log is None or log.started_at is None:
+            return None
+        return time.time() - log.started_at
+
+    def append(self, url: str, entry: LogEntry) -> None:
+        self._touch(url).entries.append(entry)
+
+    def recent(self, n: int) -> List[Tuple[str, UrlLog]]:
+        """Последние n ссылок, от старой к новой."""
+        urls = list(self._urls)[-n:] if n else []
+        return [(url, self._urls[url]) for url in urls]
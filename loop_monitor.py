@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Deque, List, Optional, Tuple
+
+import metrics
+from config import LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD, PROFILE_MAX_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Период опроса стека в профайлере, секунды
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Последние зависания цикла: (когда, сколько длилось, стек в момент зависания)
+stalls: Deque[Tuple[float, float, str]] = deque(maxlen=10)
+
+max_lag = 0.0
+_heartbeat = 0.0
+_loop_thread_id: Optional[int] = None
+_sampler: Optional[asyncio.Task] = None
+_watchdog: Optional[threading.Thread] = None
+_stop = threading.Event()
+_profiling = threading.Lock()
+
+metrics.describe("loop_lag_seconds", "Опоздание колбэков цикла событий")
+metrics.register_gauge("loop_lag_max_seconds", "Максимальное опоздание цикла, с", lambda: round(max_lag, 3))
+
+
+async def _sample_lag() -> None:
+    """Раз в LOOP_LAG_INTERVAL: насколько позже запланированного проснулись."""
+    global _heartbeat, max_lag
+    while True:
+        start = time.monotonic()
+        _heartbeat = start
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL)
+        max_lag = max(max_lag, lag)
+        metrics.observe("loop_lag_seconds", lag)
+
+
+def _loop_stack() -> str:
+    frame = sys._current_frames().get(_loop_thread_id)
+    return "".join(traceback.format_stack(frame)) if frame else ""
+
+
+def _watch() -> None:
+    """
+    Поток-сторож: цикл не обновлял heartbeat дольше LOOP_STALL_THRESHOLD →
+    снимаем стек потока цикла, пока он ещё висит в блокирующем коде.
+    """
+    reported = 0.0  # heartbeat, по которому уже сняли стек
+    while not _stop.wait(LOOP_STALL_THRESHOLD / 2):
+        beat = _heartbeat
+        stalled_for = time.monotonic() - beat - LOOP_LAG_INTERVAL
+        if beat and beat != reported and stalled_for >= LOOP_STALL_THRESHOLD:
+            reported = beat
+            stack = _loop_stack()
+            stalls.append((time.time(), stalled_for, stack))
+            logger.warning("🐢 Цикл событий завис на %.2fs, стек:\n%s", stalled_for, stack)
+
+
+def start() -> None:
+    global _sampler, _watchdog, _loop_thread_id
+    _loop_thread_id = threading.get_ident()
+    _stop.clear()
+    _sampler = asyncio.create_task(_sample_lag())
+    _watchdog = threading.Thread(target=_watch, name="loop-watchdog", daemon=True)
+    _watchdog.start()
+
+
+def stop() -> None:
+    global _sampler
+    _stop.set()
+    if _sampler is not None:
+        _sampler.cancel()
+        _sampler = None
+
+
+def get_stalls_report() -> str:
+    if not stalls:
+        return f"✅ Зависаний дольше {LOOP_STALL_THRESHOLD}s не было (макс. опоздание {max_lag:.3f}s)"
+    text = f"🐢 Последние зависания (макс. опоздание {max_lag:.3f}s):\n\n"
+    for when, duration, stack in reversed(stalls):
+        tail = "".join(stack.splitlines(keepends=True)[-8:])  # ближайшие к блокировке кадры
+        text += f"{time.strftime('%d.%m %H:%M:%S', time.localtime(when))} – {duration:.2f}s\n{tail}\n"
+    return text
+
+
+def _sample(seconds: float) -> Tuple[Counter, Counter, int]:
+    """Опрос стека потока цикла: (self-время, полное время по функциям, число снимков)."""
+    own: Counter = Counter()
+    inclusive: Counter = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(_loop_thread_id)
+        seen = set()
+        leaf = True
+        while frame is not None:
+            code = frame.f_code
+            name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            if leaf:
+                own[name] += 1
+                leaf = False
+            if name not in seen:
+                seen.add(name)
+                inclusive[name] += 1
+            frame = frame.f_back
+        samples += 1
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+    return own, inclusive, samples
+
+
+async def profile(seconds: float, top: int = 15) -> str:
+    """Сэмплирующий профайлер на seconds секунд (в отдельном потоке), топ горячих функций."""
+    seconds = max(1.0, min(seconds, PROFILE_MAX_SECONDS))
+    if not _profiling.acquire(blocking=False):
+        return "⏳ Профайлер уже запущен"
+    try:
+        own, inclusive, samples = await asyncio.to_thread(_sample, seconds)
+    finally:
+        _profiling.release()
+
+    if not samples:
+        return "Нет снимков"
+    # Цикл, ждущий событий, сидит в select/poll – это простой, а не нагрузка
+    idle = sum(n for name, n in own.items() if name.startswith(("select ", "poll ", "_run_once ")))
+    text = f"🔥 Профиль за {seconds:g}s: {samples} снимков, простой ~{idle * 100 // samples}%\n\n"
+    text += "Сами по себе (self):\n"
+    text += "".join(f"{n * 100 / samples:5.1f}% {name}\n" for name, n in own.most_common(top))
+    text += "\nВместе с вызванными (total):\n"
+    hot: List[Tuple[str, int]] = [(name, n) for name, n in inclusive.most_common(top * 2) if n < samples][:top]
+    text += "".join(f"{n * 100 / samples:5.1f}% {name}\n" for name, n in hot)
+    return text
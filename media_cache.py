@@ -0,0 +1,78 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Union
+
+from config import MEDIA_CACHE_FILE, MEDIA_CACHE_MAX_ENTRIES, MEDIA_CACHE_TTL
+from json_store import JsonFile
+from utils import canonical_url
+
+logger = logging.getLogger(__name__)
+
+# Минимальная пауза между записями файла кэша
+SAVE_INTERVAL = 30
+
+# FORMAT:
+# {
+#   "https://tiktok.com/@user/video/123": {
+#       "media_type": "video" | "image" | "slideshow",
+#       "media": "<file_id>" | {"images": ["<file_id>", ...], "audio": "<file_id>" | None},
+#       "platform": "TikTok",
+#       "created": 1700000000.0
+#   }
+# }
+# OrderedDict → LRU: самые свежие обращения в конце.
+_entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_store = JsonFile(MEDIA_CACHE_FILE, SAVE_INTERVAL, ensure_ascii=False)
+
+
+def get(url: str) -> Optional[Dict[str, Any]]:
+    """Запись кэша для ссылки (или None, если нет / устарела)."""
+    key = canonical_url(url)
+    entry = _entries.get(key)
+    if entry is None:
+        return None
+    if time.time() - entry["created"] > MEDIA_CACHE_TTL:
+        del _entries[key]
+        return None
+    _entries.move_to_end(key)
+    return entry
+
+
+def put(url: str, media_type: str, media: Union[str, Dict[str, Any]], platform: str) -> None:
+    """Запоминаем file_id, которые Telegram вернул после отправки."""
+    key = canonical_url(url)
+    _entries[key] = {
+        "media_type": media_type,
+        "media": media,
+        "platform": platform,
+        "created": time.time(),
+    }
+    _entries.move_to_end(key)
+    while len(_entries) > MEDIA_CACHE_MAX_ENTRIES:
+        _entries.popitem(last=False)
+    _save_throttled()
+
+
+def invalidate(url: str) -> None:
+    """Telegram отверг file_id → забываем ссылку."""
+    if _entries.pop(canonical_url(url), None) is not None:
+        logger.info("🗑 file_id cache invalidated: %s", url[:50])
+        _save_throttled()
+
+
+def _save_throttled() -> None:
+    if _store.due():
+        save()
+
+
+def load() -> None:
+    data = _store.load() or {}
+    now = time.time()
+    for key, entry in data.items():
+        if now - entry.get("created", 0) <= MEDIA_CACHE_TTL:
+            _entries[key] = entry
+
+
+def save() -> None:
+    _store.save(_entries)
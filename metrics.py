@@ -0,0 +1,208 @@
+import bisect
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм длительности, секунды
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Счётчики по корзинам + сумма, как у гистограммы Prometheus."""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(DURATION_BUCKETS) + 1)  # последняя – +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(DURATION_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по корзинам (линейно внутри корзины)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                if i == len(DURATION_BUCKETS):
+                    return DURATION_BUCKETS[-1]
+                lower = DURATION_BUCKETS[i - 1] if i else 0.0
+                return lower + (DURATION_BUCKETS[i] - lower) * (rank - seen) / n
+            seen += n
+        return DURATION_BUCKETS[-1]
+
+
+_help: Dict[str, str] = {}
+histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+counters: Dict[str, Dict[LabelKey, float]] = {}
+gauges: Dict[str, Callable[[], float]] = {}
+
+_runner: Optional[web.AppRunner] = None
+
+
+def _key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def observe(name: str, value: float, **labels: str) -> None:
+    series = histograms.setdefault(name, {})
+    key = _key(labels)
+    histogram = series.get(key)
+    if histogram is None:
+        histogram = series[key] = Histogram()
+    histogram.observe(value)
+
+
+def inc(name: str, value: float = 1, **labels: str) -> None:
+    series = counters.setdefault(name, {})
+    key = _key(labels)
+    series[key] = series.get(key, 0) + value
+
+
+def register_gauge(name: str, help_text: str, read: Callable[[], float]) -> None:
+    """Gauge читается в момент выгрузки (очереди, задачи в работе)."""
+    _help[name] = help_text
+    gauges[name] = read
+
+
+def describe(name: str, help_text: str) -> None:
+    _help[name] = help_text
+
+
+@contextmanager
+def timer(name: str, **labels: str) -> Iterator[None]:
+    """
+    Замер этапа: длительность в гистограмму name, результат (ok/error) – в метку.
+    Платформа берётся из трассы задачи; сам этап попадает в неё спаном.
+    """
+    trace = tracing.current()
+    labels = {"platform": trace.platform if trace else "", **labels}
+    start = time.perf_counter()
+    result = "ok"
+    try:
+        with tracing.span(labels.get("stage", name), source=labels.get("source", "")):
+            yield
+    except BaseException:
+        result = "error"
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, result=result, **labels)
+
+
+def timed(name: str, **labels: str):
+    """Декоратор для async-функции-этапа: то же, что timer вокруг всего вызова."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _format_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines: List[str] = []
+    for name, series in sorted(counters.items()):
+        lines += [f"# HELP {name} {_help.get(name, name)}", f"# TYPE {name} counter"]
+        lines += [f"{name}{_format_labels(key)} {value}" for key, value in series.items()]
+    for name, read in sorted(gauges.items()):
+        try:
+            value = read()
+        except Exception as e:
+            logger.debug("gauge %s: %s", name, e)
+            continue
+        lines += [f"# HELP {name} {_help.get(name, name)}", f"# TYPE {name} gauge", f"{name} {value}"]
+    for name, series in sorted(histograms.items()):
+        lines += [f"# HELP {name} {_help.get(name, name)}", f"# TYPE {name} histogram"]
+        for key, histogram in series.items():
+            cumulative = 0
+            for bound, n in zip(DURATION_BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_format_labels(key, (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def get_perf_report() -> str:
+    """Сводка для /perf: p50/p95 по этапам и API, объёмы, очереди."""
+    text = "⏱ Этапы (p50 / p95, штук):\n"
+    for name in ("stage_seconds", "api_request_seconds", "job_seconds"):
+        for key, histogram in sorted(histograms.get(name, {}).items()):
+            labels = " ".join(value for label, value in key if value and label != "result")
+            result = dict(key).get("result", "")
+            mark = "❌ " if result == "error" else ""
+            if result not in ("ok", "error"):
+                labels += f" {result}"
+            text += (f"{mark}{labels}: {histogram.quantile(0.5):.2f}s / {histogram.quantile(0.95):.2f}s,"
+                     f" {histogram.count}\n")
+        text += "\n"
+
+    for name, title in (("downloaded_bytes_total", "⬇️ Скачано"), ("uploaded_bytes_total", "⬆️ Отправлено")):
+        total = sum(counters.get(name, {}).values())
+        text += f"{title}: {total / 1024 / 1024:.1f} MB\n"
+
+    for name, read in sorted(gauges.items()):
+        try:
+            text += f"📊 {_help.get(name, name)}: {read()}\n"
+        except Exception:
+            pass
+    return text
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def startup() -> None:
+    """Локальный HTTP /metrics для Prometheus (METRICS_PORT=0 – выключен)."""
+    global _runner
+    if not METRICS_PORT:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info("📈 Метрики: http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+
+
+async def shutdown() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+
+
+describe("stage_seconds", "Длительность этапов обработки (resolve/download/compress/remux/upload)")
+describe("api_request_seconds", "Длительность запросов к API TikTok/Instagram")
+describe("job_seconds", "Полное время задачи от старта до отправки")
+describe("jobs_total", "Задачи по платформам и результату")
+describe("downloaded_bytes_total", "Скачано байт")
+describe("uploaded_bytes_total", "Отправлено в Telegram байт")
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Union
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    DeleteMessage,
+    DeleteMessages,
+    EditMessageCaption,
+    EditMessageText,
+    SendChatAction,
+    SendMediaGroup,
+)
+
+import metrics
+from config import (
+    TG_COSMETIC_RESERVE,
+    TG_GLOBAL_PER_SECOND,
+    TG_GROUP_BURST,
+    TG_GROUP_PER_MINUTE,
+    TG_MAX_RETRIES,
+    TG_PRIVATE_BURST,
+    TG_PRIVATE_PER_SECOND,
+)
+
+logger = logging.getLogger(__name__)
+
+# Удаления и правки «⏳ обработка» – косметика: уступают отправкам
+COSMETIC_METHODS = (DeleteMessage, DeleteMessages, EditMessageText, EditMessageCaption, SendChatAction)
+
+# Столько корзин чатов держим, дальше выбрасываем полные
+MAX_CHAT_BUCKETS = 1000
+
+
+class TokenBucket:
+    """Токены пополняются со скоростью rate в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # retry_after от Telegram
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def blocked_for(self) -> float:
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    def delay(self, cost: float = 1, reserve: float = 0.0) -> float:
+        """
+        Сколько ждать до cost свободных токенов (0 → можно сейчас), не трогая
+        reserve токенов сверх них. Больше capacity не ждём: запрос уходит при
+        полной корзине и уводит её в минус.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        need = min(cost + reserve, self.capacity)
+        missing = 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+        return max(missing, self.blocked_until - now)
+
+    def take(self, cost: float = 1) -> None:
+        self.tokens -= cost
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and not self.blocked_for()
+
+
+_global = TokenBucket(TG_GLOBAL_PER_SECOND, TG_GLOBAL_PER_SECOND)
+_chats: Dict[Union[int, str], TokenBucket] = {}
+
+# Отправки, ждущие глобальный токен: пока они есть, косметика не идёт
+waiting_sends = 0
+_sends_idle = asyncio.Event()
+_sends_idle.set()
+
+# Сколько раз Telegram ответил 429
+throttled = 0
+
+metrics.register_gauge("telegram_waiting_sends", "Отправок ждут лимита Bot API", lambda: waiting_sends)
+
+
+def _chat_bucket(chat_id: Union[int, str]) -> TokenBucket:
+    bucket = _chats.get(chat_id)
+    if bucket is None:
+        if len(_chats) >= MAX_CHAT_BUCKETS:
+            for key in [key for key, b in _chats.items() if b.idle]:
+                del _chats[key]
+        is_group = not isinstance(chat_id, int) or chat_id < 0
+        if is_group:
+            bucket = TokenBucket(TG_GROUP_PER_MINUTE / 60, TG_GROUP_BURST)
+        else:
+            bucket = TokenBucket(TG_PRIVATE_PER_SECOND, TG_PRIVATE_BURST)
+        _chats[chat_id] = bucket
+    return bucket
+
+
+def _cost(method) -> int:
+    """Альбом Telegram считает по числу сообщений в нём."""
+    if isinstance(method, SendMediaGroup):
+        return max(1, len(method.media))
+    return 1
+
+
+async def _acquire_send(bucket: TokenBucket, cost: int = 1) -> None:
+    global waiting_sends
+    while (wait := bucket.delay(cost)) > 0:
+        await asyncio.sleep(wait)
+    bucket.take(cost)
+
+    waiting_sends += 1
+    _sends_idle.clear()
+    try:
+        while (wait := _global.delay(cost)) > 0:
+            await asyncio.sleep(wait)
+        _global.take(cost)
+    finally:
+        waiting_sends -= 1
+        if not waiting_sends:
+            _sends_idle.set()
+
+
+def _cosmetic_reserve(bucket: TokenBucket) -> float:
+    return bucket.capacity * TG_COSMETIC_RESERVE
+
+
+async def _acquire_cosmetic(bucket: TokenBucket) -> None:
+    """
+    Правки и удаления тоже расходуют лимит чата, но с низким приоритетом:
+    идут, только пока в корзине остаётся резерв для отправок.
+    """
+    while True:
+        await _sends_idle.wait()
+        wait = max(bucket.delay(1, _cosmetic_reserve(bucket)), _global.delay())
+        if wait <= 0:
+            bucket.take()
+            _global.take()
+            return
+        await asyncio.sleep(wait)
+
+
+def has_spare(chat_id: Union[int, str]) -> bool:
+    """
+    Есть ли у чата запас на косметику прямо сейчас. Необязательные правки
+    (прогресс) при нехватке лучше пропустить, чем ставить в очередь.
+    """
+    bucket = _chats.get(chat_id)
+    if bucket is None:
+        return True
+    return bucket.delay(1, _cosmetic_reserve(bucket)) <= 0
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Все запросы бота к конкретному чату проходят через корзины токенов:
+    глобальную и чата (косметика – не трогая резерв отправок).
+    429 → ждём retry_after и повторяем.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        global throttled
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        cosmetic = isinstance(method, COSMETIC_METHODS)
+        bucket = _chat_bucket(chat_id)
+        for attempt in range(TG_MAX_RETRIES + 1):
+            if cosmetic:
+                await _acquire_cosmetic(bucket)
+            else:
+                await _acquire_send(bucket, _cost(method))
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                throttled += 1
+                metrics.inc("telegram_retry_after_total", method=type(method).__name__)
+                bucket.block(e.retry_after)
+                logger.warning("429 в чате %s (%s): ждём %ss", chat_id, type(method).__name__, e.retry_after)
+                if attempt == TG_MAX_RETRIES:
+                    raise
+
+
+def queue_stats() -> Dict[str, int]:
+    """Для /apis: ждущие отправки и число 429."""
+    return {'waiting_sends': waiting_sends, 'throttled': throttled}
@@ -0,0 +1,186 @@
+import html
+import logging
+import sqlite3
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from config import ROLLUP_DAILY_KEEP_DAYS, ROLLUP_HOURLY_KEEP_HOURS, ROLLUP_MONTHLY_KEEP_MONTHS
+
+logger = logging.getLogger(__name__)
+
+# Уровни корзин: свежие события – по часам, старше ROLLUP_HOURLY_KEEP_HOURS
+# сливаются в дни, старше ROLLUP_DAILY_KEEP_DAYS – в месяцы (UTC).
+HOUR, DAY, MONTH = "hour", "day", "month"
+
+# Как часто проверять, не пора ли укрупнить старые корзины
+COMPACT_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollups (
+    level     TEXT NOT NULL,
+    start     INTEGER NOT NULL,
+    chat_id   INTEGER NOT NULL,
+    platform  TEXT NOT NULL,
+    username  TEXT NOT NULL,
+    posts     INTEGER NOT NULL DEFAULT 0,
+    reactions INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (level, start, chat_id, platform, username)
+);
+"""
+
+
+class BucketKey(NamedTuple):
+    level: str
+    start: int  # начало корзины, unix-время
+    chat_id: int
+    platform: str
+    username: str
+
+
+# Корзина → [видео, реакций]
+buckets: Dict[BucketKey, List[int]] = {}
+_dirty: Set[BucketKey] = set()
+_removed: Set[BucketKey] = set()
+_last_compact = 0.0
+
+
+def hour_start(ts: float) -> int:
+    return int(ts // 3600 * 3600)
+
+
+def day_start(ts: float) -> int:
+    return int(ts // 86400 * 86400)
+
+
+def month_start(ts: float) -> int:
+    dt = datetime.fromtimestamp(ts, timezone.utc)
+    return int(datetime(dt.year, dt.month, 1, tzinfo=timezone.utc).timestamp())
+
+
+def months_ago(ts: float, months: int) -> int:
+    dt = datetime.fromtimestamp(ts, timezone.utc)
+    year, month = divmod(dt.year * 12 + dt.month - 1 - months, 12)
+    return int(datetime(year, month + 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+def load(db: sqlite3.Connection) -> None:
+    db.executescript(SCHEMA)
+    for level, start, chat_id, platform, username, posts, reactions in db.execute(
+        "SELECT level, start, chat_id, platform, username, posts, reactions FROM rollups"
+    ):
+        buckets[BucketKey(level, start, chat_id, platform, username)] = [posts, reactions]
+
+
+def is_dirty() -> bool:
+    return bool(_dirty or _removed)
+
+
+def flush(db: sqlite3.Connection) -> None:
+    """Записать изменённые корзины (вызывается внутри транзакции stats.flush)."""
+    db.executemany(
+        "DELETE FROM rollups WHERE level = ? AND start = ? AND chat_id = ? AND platform = ? AND username = ?",
+        list(_removed),
+    )
+    db.executemany(
+        "INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(*key, *buckets[key]) for key in _dirty if key in buckets],
+    )
+    _dirty.clear()
+    _removed.clear()
+
+
+def _add(key: BucketKey, posts: int, reactions: int) -> None:
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = [0, 0]
+        _removed.discard(key)
+    bucket[0] += posts
+    bucket[1] += reactions
+    _dirty.add(key)
+
+
+def record(chat_id: int, platform: str, username: str, posts: int = 0, reactions: int = 0, ts: Optional[float] = None) -> None:
+    """Учесть отправленное видео и/или изменение числа реакций на нём."""
+    ts = time.time() if ts is None else ts
+    _add(BucketKey(HOUR, hour_start(ts), chat_id, platform or "", username or ""), posts, reactions)
+    if ts - _last_compact >= COMPACT_INTERVAL:
+        compact(ts)
+
+
+def compact(now: Optional[float] = None) -> None:
+    """Слить старые часы в дни, старые дни – в месяцы, выбросить то, что старше года."""
+    global _last_compact
+    now = time.time() if now is None else now
+    _last_compact = now
+    hour_limit = hour_start(now - ROLLUP_HOURLY_KEEP_HOURS * 3600)
+    day_limit = day_start(now - ROLLUP_DAILY_KEEP_DAYS * 86400)
+    month_limit = months_ago(now, ROLLUP_MONTHLY_KEEP_MONTHS)
+
+    merged = 0
+    # По уровням по очереди: часы, слитые в дни, могут сразу уйти в месяцы
+    for level, limit, coarser_level, coarser_start in (
+        (HOUR, hour_limit, DAY, day_start),
+        (DAY, day_limit, MONTH, month_start),
+        (MONTH, month_limit, None, None),
+    ):
+        for key in [k for k in buckets if k.level == level and k.start < limit]:
+            posts, reactions = buckets.pop(key)
+            _dirty.discard(key)
+            _removed.add(key)
+            if coarser_level is not None:
+                _add(key._replace(level=coarser_level, start=coarser_start(key.start)), posts, reactions)
+            merged += 1
+    if merged:
+        logger.info("rollups: укрупнено %d корзин, всего %d", merged, len(buckets))
+
+
+def window(seconds: float, chat_id: Optional[int] = None, now: Optional[float] = None) -> Dict[Tuple[str, str], List[int]]:
+    """
+    Сумма корзин за последние seconds секунд: {(platform, username): [видео, реакций]}.
+    Корзина попадает в окно, если началась не раньше его начала (для дней/месяцев –
+    с точностью до корзины).
+    """
+    now = time.time() if now is None else now
+    since = now - seconds
+    totals: Dict[Tuple[str, str], List[int]] = {}
+    for key, (posts, reactions) in buckets.items():
+        if key.start < since and key.level == HOUR:
+            continue
+        if key.level == DAY and key.start < day_start(since):
+            continue
+        if key.level == MONTH and key.start < month_start(since):
+            continue
+        if chat_id is not None and key.chat_id != chat_id:
+            continue
+        total = totals.setdefault((key.platform, key.username), [0, 0])
+        total[0] += posts
+        total[1] += reactions
+    return totals
+
+
+def get_window_report(title: str, seconds: float, chat_id: Optional[int] = None, top: int = 3) -> str:
+    """Отчёт за период: видео и реакции, разбивка по платформам, топ авторов по реакциям."""
+    totals = window(seconds, chat_id)
+    posts = sum(p for p, _ in totals.values())
+    reactions = sum(r for _, r in totals.values())
+    if not posts and not reactions:
+        return f"📅 <b>{title}:</b> пусто"
+
+    platforms: Dict[str, List[int]] = {}
+    users: Dict[str, List[int]] = {}
+    for (platform, username), (p, r) in totals.items():
+        for group, name in ((platforms, platform), (users, username)):
+            total = group.setdefault(name, [0, 0])
+            total[0] += p
+            total[1] += r
+
+    text = f"📅 <b>{title}:</b> видео {posts}, реакций {reactions}\n"
+    for platform, (p, r) in sorted(platforms.items(), key=lambda x: x[1][1], reverse=True):
+        text += f"📱 {html.escape(platform or '?')}: {p} видео, {r} реакций\n"
+
+    text += "\n👑 <b>Топ авторов:</b>\n"
+    ranked = sorted(users.items(), key=lambda x: (x[1][1], x[1][0]), reverse=True)[:top]
+    for i, (username, (p, r)) in enumerate(ranked, 1):
+        text += f"{i}. {html.escape(username or '?')} – {r} реакций, {p} видео\n"
+    return text
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+import metrics
+from config import (
+    SCHEDULER_GLOBAL_LIMIT,
+    SCHEDULER_MAX_QUEUE,
+    SCHEDULER_MAX_QUEUE_PER_CHAT,
+    SCHEDULER_MAX_QUEUE_PER_USER,
+    SCHEDULER_PLATFORM_LIMITS,
+    SCHEDULER_POSITION_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+class Job:
+    """Одна ссылка в очереди планировщика."""
+
+    def __init__(
+        self,
+        chat_id: int,
+        user_id: int,
+        platform: str,
+        factory: Callable[[], Awaitable[None]],
+        on_position: Optional[PositionCallback] = None,
+    ):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.platform = platform
+        self.factory = factory
+        self.on_position = on_position
+        self.position = 0     # текущий номер в очереди
+        self.shown = 0        # номер, который видит пользователь
+        self.shown_at = 0.0   # когда его последний раз правили
+
+
+# Очереди: чат → пользователь → задачи. Порядок ключей = очередь round-robin.
+_queues: "OrderedDict[int, OrderedDict[int, Deque[Job]]]" = OrderedDict()
+_running: Dict[str, int] = {}  # platform → сколько выполняется
+running_total = 0
+queued_total = 0
+_positions_task: Optional[asyncio.Task] = None
+
+
+def _platform_free(platform: str) -> bool:
+    limit = SCHEDULER_PLATFORM_LIMITS.get(platform, SCHEDULER_GLOBAL_LIMIT)
+    return _running.get(platform, 0) < limit
+
+
+def _pop_next() -> Optional[Job]:
+    """
+    Следующая задача: по кругу по чатам, внутри чата — по кругу по пользователям.
+    Задачи платформы, у которой нет свободных слотов, пропускаются.
+    """
+    for chat_id in list(_queues):
+        users = _queues[chat_id]
+        for user_id in list(users):
+            jobs = users[user_id]
+            if not _platform_free(jobs[0].platform):
+                continue
+            job = jobs.popleft()
+            # Отработавший пользователь и чат уходят в конец круга
+            if jobs:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            if users:
+                _queues.move_to_end(chat_id)
+            else:
+                del _queues[chat_id]
+            return job
+    return None
+
+
+def _queue_order() -> List[Job]:
+    """Ожидаемый порядок запуска (для номера в очереди): тот же круг, без учёта лимитов."""
+    chats = OrderedDict(
+        (chat_id, OrderedDict((user_id, deque(jobs)) for user_id, jobs in users.items()))
+        for chat_id, users in _queues.items()
+    )
+    order: List[Job] = []
+    while chats:
+        chat_id, users = next(iter(chats.items()))
+        user_id, jobs = next(iter(users.items()))
+        order.append(jobs.popleft())
+        if jobs:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            chats.move_to_end(chat_id)
+        else:
+            del chats[chat_id]
+    return order
+
+
+async def _call_position(callback: PositionCallback, position: int) -> None:
+    try:
+        await callback(position)
+    except Exception as e:
+        logger.debug("Position callback failed: %s", e)
+
+
+def _notify_positions() -> None:
+    """
+    Номер в очереди в «⏳» сообщении. Одно сообщение правится не чаще раза
+    в SCHEDULER_POSITION_INTERVAL: сдвиги за это время схлопываются в одну правку.
+    """
+    global _positions_task
+    now = time.monotonic()
+    delayed = False
+    for position, job in enumerate(_queue_order(), 1):
+        job.position = position
+        if job.on_position is None or job.shown == position:
+            continue
+        if now - job.shown_at >= SCHEDULER_POSITION_INTERVAL:
+            job.shown, job.shown_at = position, now
+            asyncio.create_task(_call_position(job.on_position, position))
+        else:
+            delayed = True
+    if delayed and _positions_task is None:
+        _positions_task = asyncio.create_task(_notify_later())
+
+
+async def _notify_later() -> None:
+    global _positions_task
+    try:
+        await asyncio.sleep(SCHEDULER_POSITION_INTERVAL)
+    finally:
+        _positions_task = None
+    _notify_positions()
+
+
+async def _run(job: Job) -> None:
+    global running_total
+    try:
+        await job.factory()
+    except Exception as e:
+        logger.error("Scheduled job failed: %s", e, exc_info=True)
+    finally:
+        running_total -= 1
+        _running[job.platform] -= 1
+        _dispatch()
+
+
+def _dispatch() -> None:
+    """Запускаем задачи, пока есть свободные слоты."""
+    global running_total, queued_total
+    while running_total < SCHEDULER_GLOBAL_LIMIT:
+        job = _pop_next()
+        if job is None:
+            break
+        queued_total -= 1
+        running_total += 1
+        _running[job.platform] = _running.get(job.platform, 0) + 1
+        if job.shown and job.on_position is not None:
+            # Была в очереди → сообщаем, что началась обработка
+            asyncio.create_task(_call_position(job.on_position, 0))
+        asyncio.create_task(_run(job))
+    _notify_positions()
+
+
+async def submit(
+    chat_id: int,
+    user_id: int,
+    platform: str,
+    factory: Callable[[], Awaitable[None]],
+    on_position: Optional[PositionCallback] = None,
+) -> bool:
+    """
+    Поставить загрузку в очередь. False — задача не принята: переполнена общая
+    очередь или очередь чата / пользователя.
+
+    on_position(n) вызывается при изменении номера в очереди; n = 0 — задача запущена.
+    """
+    global queued_total
+    if queued_total >= SCHEDULER_MAX_QUEUE:
+        logger.warning("🚦 Queue full (%d), rejecting job from chat %s", queued_total, chat_id)
+        return False
+
+    # Один чат / пользователь не должен занять всю общую очередь
+    users = _queues.get(chat_id, {})
+    chat_queued = sum(len(jobs) for jobs in users.values())
+    user_queued = len(users.get(user_id, ()))
+    if chat_queued >= SCHEDULER_MAX_QUEUE_PER_CHAT or user_queued >= SCHEDULER_MAX_QUEUE_PER_USER:
+        logger.warning("🚦 Queue limit for chat %s / user %s (%d / %d), rejecting job",
+                       chat_id, user_id, chat_queued, user_queued)
+        return False
+
+    job = Job(chat_id, user_id, platform, factory, on_position)
+    users = _queues.setdefault(chat_id, OrderedDict())
+    users.setdefault(user_id, deque()).append(job)
+    queued_total += 1
+    _dispatch()
+    return True
+
+
+metrics.register_gauge("scheduler_running_jobs", "Загрузок в работе", lambda: running_total)
+metrics.register_gauge("scheduler_queued_jobs", "Загрузок в очереди", lambda: queued_total)
+
+
+def queue_stats() -> Dict[str, int]:
+    return {"running": running_total, "queued": queued_total, **{f"running_{p}": n for p, n in _running.items()}}
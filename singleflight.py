@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import metrics
+import transcode
+from downloaders import download_video
+from utils import canonical_url
+
+logger = logging.getLogger(__name__)
+
+DownloadResult = Tuple[Union[str, Dict], str, str]
+
+
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+
+class SharedDownload:
+    """Одна загрузка ссылки на всех, кто прислал её одновременно (в любых чатах)."""
+
+    def __init__(self):
+        self.task: Optional["asyncio.Task[DownloadResult]"] = None
+        self.refs = 0
+        self.listeners: List[ProgressCallback] = []
+        self.status: Optional[str] = None  # последний ещё не показанный прогресс
+        self._sender: Optional[asyncio.Task] = None
+
+    def report(self, status: str) -> None:
+        """
+        Прогресс (например, сжатия) — всем чатам, ждущим эту загрузку.
+        Не ждёт Telegram: запоминаем последний статус, шлёт его отдельная задача;
+        пока она занята, промежуточные статусы заменяются более свежими.
+        """
+        self.status = status
+        if self._sender is None:
+            self._sender = asyncio.create_task(self._send())
+
+    async def _send(self) -> None:
+        try:
+            while self.status is not None:
+                status, self.status = self.status, None
+                await asyncio.gather(*(self._notify(listener, status) for listener in list(self.listeners)))
+        finally:
+            self._sender = None
+
+    @staticmethod
+    async def _notify(listener: ProgressCallback, status: str) -> None:
+        try:
+            await listener(status)
+        except Exception as e:
+            logger.debug("Progress listener failed: %s", e)
+
+    async def run(self, url: str, platform: str) -> DownloadResult:
+        transcode.progress_listener.set(self.report)
+        try:
+            return await download_video(url, platform)
+        finally:
+            # Загрузка закончилась – прогресс больше не нужен
+            self.status = None
+            if self._sender is not None:
+                self._sender.cancel()
+
+
+# {canonical_url: SharedDownload}
+inflight_downloads: Dict[str, SharedDownload] = {}
+metrics.register_gauge("inflight_downloads", "Общих загрузок в работе", lambda: len(inflight_downloads))
+
+
+async def acquire(
+    url: str,
+    platform: str,
+    on_progress: Optional[ProgressCallback] = None,
+) -> DownloadResult:
+    """
+    Скачать ссылку или присоединиться к уже идущей загрузке.
+
+    После отправки каждый потребитель обязан вызвать release(url):
+    временные файлы удаляются, когда их отпустит последний.
+    """
+    key = canonical_url(url)
+    shared = inflight_downloads.get(key)
+    if shared is None:
+        shared = SharedDownload()
+        shared.task = asyncio.create_task(shared.run(url, platform))
+        inflight_downloads[key] = shared
+    else:
+        logger.info("🔗 Joined in-flight download: %s (%d waiting)", url[:50], shared.refs)
+    shared.refs += 1
+    if on_progress is not None:
+        shared.listeners.append(on_progress)
+    # shield: отмена одного потребителя не отменяет общую загрузку
+    return await asyncio.shield(shared.task)
+
+
+async def release(url: str, on_progress: Optional[ProgressCallback] = None) -> None:
+    """Отпустить результат загрузки; последний потребитель удаляет файлы."""
+    key = canonical_url(url)
+    shared = inflight_downloads.get(key)
+    if shared is None:
+        return
+    shared.refs -= 1
+    if on_progress in shared.listeners:
+        shared.listeners.remove(on_progress)
+    if shared.refs > 0:
+        return
+
+    del inflight_downloads[key]
+    if not shared.task.done():
+        # Никто больше не ждёт → загрузку отменяем, а если успеет завершиться — чистим файлы
+        shared.task.cancel()
+        shared.task.add_done_callback(lambda task: asyncio.ensure_future(_cleanup_task_result(task)))
+        return
+    await _cleanup_task_result(shared.task)
+
+
+async def _cleanup_task_result(task: "asyncio.Task[DownloadResult]") -> None:
+    if task.cancelled() or task.exception() is not None:
+        return
+    file_path, _, _ = task.result()
+    await cleanup_media(file_path)
+
+
+async def cleanup_media(file_path: Union[str, Dict, None]) -> None:
+    """Удаление временных файлов (видео/фото или слайдшоу)."""
+    if isinstance(file_path, dict):
+        paths = list(file_path.get('images', []))
+        if file_path.get('audio'):
+            paths.append(file_path['audio'])
+    elif file_path:
+        paths = [file_path]
+    else:
+        paths = []
+
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        try:
+            os.remove(path)
+        except Exception as rm_error:
+            logger.error("Ошибка при удалении файла: %s", rm_error)
+            # Файл может быть ещё открыт — пробуем ещё раз через секунду
+            await asyncio.sleep(1)
+            try:
+                os.remove(path)
+                logger.info("Файл удален со второй попытки: %s", path)
+            except Exception:
+                pass
+    if paths:
+        logger.info("Временные файлы удалены: %d", len(paths))
@@ -1,142 +1,331 @@
+import asyncio
 import json
 import os
 import logging
-from collections import defaultdict
-from typing import Dict, Any, List
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Set, Tuple
 
 from aiogram.types import MessageReactionUpdated
 
+from config import STATS_FLUSH_EVENTS, STATS_FLUSH_INTERVAL, STATS_MAX_MESSAGES, STATS_TOP_K
+from leaderboard import Leaderboard
+import rollups
+
 logger = logging.getLogger(__name__)
 
-STATS_FILE = "stats.json"
-
-# FORMAT:
-# {
-#   "messages": {
-#       "chat_id:message_id": {
-#           "url": "http...",
-#           "username": "user",
-#           "platform": "tiktok",
-#           "reactions": {"🔥": 1, ...}
-#       }
-#   },
-#   "global": {
-#       "🔥": 10,
-#       "❤️": 5
-#   }
-# }
-
-def load_stats() -> Dict[str, Any]:
+STATS_DB = "stats.db"
+STATS_FILE = "stats.json"  # старый формат, переносится в STATS_DB один раз
+
+# Сколько последних сообщений отслеживаем (старые удаляются вместе с реакциями)
+MAX_MESSAGES = STATS_MAX_MESSAGES
+
+# SQLite в режиме WAL: каждое событие – одна короткая транзакция,
+# без перечитывания и перезаписи всего файла.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id    INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    url        TEXT NOT NULL,
+    username   TEXT,
+    platform   TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS messages_created ON messages (created_at);
+
+CREATE TABLE IF NOT EXISTS reactions (
+    chat_id    INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    emoji      TEXT NOT NULL,
+    count      INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, message_id, emoji)
+);
+
+CREATE TABLE IF NOT EXISTS global_reactions (
+    emoji TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS config (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_db: Optional[sqlite3.Connection] = None
+
+MessageKey = Tuple[int, int]  # (chat_id, message_id)
+
+# Живое состояние: загружается из базы при первом обращении
+_messages: "OrderedDict[MessageKey, Dict[str, Any]]" = OrderedDict()  # от старых к новым
+_global: Dict[str, int] = {}
+_config: Dict[str, Any] = {}
+_loaded = False
+
+# Рейтинги обновляются вместе со счётчиками → топ за O(K)
+top_messages: Leaderboard[MessageKey] = Leaderboard()      # по сумме реакций, все чаты
+chat_top_messages: Dict[int, Leaderboard[MessageKey]] = {}  # то же по каждому чату
+top_emojis: Leaderboard[str] = Leaderboard()                # глобальные счётчики эмодзи
+
+# Что изменилось с последней записи в базу
+_dirty_messages: Set[MessageKey] = set()
+_removed_messages: Set[MessageKey] = set()
+_dirty_global: Set[str] = set()
+_pending_events = 0
+_flush_task: Optional[asyncio.Task] = None
+
+
+def get_db() -> sqlite3.Connection:
+    """Соединение с базой (создаётся при первом обращении, заодно миграция stats.json)."""
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(STATS_DB, isolation_level=None)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.executescript(SCHEMA)
+        migrate_json()
+    return _db
+
+
+def close() -> None:
+    """Записать несохранённое и закрыть базу (при остановке бота)."""
+    global _db
+    flush()
+    if _db is not None:
+        _db.close()
+        _db = None
+
+
+def _load() -> None:
+    """Поднять счётчики из базы в память (один раз)."""
+    global _loaded
+    if _loaded:
+        return
+    db = get_db()
+    for chat_id, message_id, url, username, platform, created_at in db.execute(
+        "SELECT chat_id, message_id, url, username, platform, created_at FROM messages ORDER BY created_at"
+    ):
+        _messages[(chat_id, message_id)] = {
+            "url": url, "username": username, "platform": platform,
+            "created_at": created_at, "reactions": {},
+        }
+    for chat_id, message_id, emoji, count in db.execute("SELECT chat_id, message_id, emoji, count FROM reactions"):
+        msg = _messages.get((chat_id, message_id))
+        if msg is not None:
+            msg["reactions"][emoji] = count
+    for key, msg in _messages.items():  # от старых к новым → при равенстве выше старое
+        _rank_message(key, sum(msg["reactions"].values()))
+    _global.update(db.execute("SELECT emoji, count FROM global_reactions"))
+    for emoji, count in _global.items():
+        top_emojis.set(emoji, count)
+    rollups.load(db)
+    _config.update((key, json.loads(value)) for key, value in db.execute("SELECT key, value FROM config"))
+    _loaded = True
+
+
+def flush() -> None:
+    """Записать накопленные изменения одной транзакцией."""
+    global _pending_events
+    if not (_dirty_messages or _removed_messages or _dirty_global or rollups.is_dirty()):
+        return
+    db = get_db()
+    with db:
+        db.execute("BEGIN")
+        for chat_id, message_id in _removed_messages:
+            db.execute("DELETE FROM messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+            db.execute("DELETE FROM reactions WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+        for key in _dirty_messages:
+            msg = _messages.get(key)
+            if msg is None:
+                continue
+            db.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, msg["url"], msg["username"], msg["platform"], msg["created_at"]),
+            )
+            db.execute("DELETE FROM reactions WHERE chat_id = ? AND message_id = ?", key)
+            db.executemany(
+                "INSERT INTO reactions VALUES (?, ?, ?, ?)",
+                [(*key, emoji, count) for emoji, count in msg["reactions"].items()],
+            )
+        db.executemany(
+            "INSERT OR REPLACE INTO global_reactions VALUES (?, ?)",
+            [(emoji, _global[emoji]) for emoji in _dirty_global],
+        )
+        rollups.flush(db)
+    logger.debug("stats: записано %d сообщений, %d эмодзи", len(_dirty_messages), len(_dirty_global))
+    _dirty_messages.clear()
+    _removed_messages.clear()
+    _dirty_global.clear()
+    _pending_events = 0
+
+
+async def _flush_later() -> None:
+    global _flush_task
+    try:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+    finally:
+        _flush_task = None
+    flush()
+
+
+def _rank_message(key: MessageKey, total: int) -> None:
+    top_messages.set(key, total)
+    board = chat_top_messages.get(key[0])
+    if board is None:
+        if total <= 0:
+            return
+        board = chat_top_messages[key[0]] = Leaderboard()
+    board.set(key, total)
+    if not board:
+        del chat_top_messages[key[0]]
+
+
+def _mark_dirty() -> None:
+    """Событие изменило счётчики: пишем по таймеру или сразу после STATS_FLUSH_EVENTS."""
+    global _pending_events, _flush_task
+    _pending_events += 1
+    if _pending_events >= STATS_FLUSH_EVENTS:
+        flush()
+    elif _flush_task is None:
+        _flush_task = asyncio.create_task(_flush_later())
+
+
+def migrate_json() -> None:
+    """Однократный перенос stats.json в SQLite; старый файл переименовывается."""
     if not os.path.exists(STATS_FILE):
-        return {"messages": {}, "global": {}}
+        return
     try:
         with open(STATS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+            data = json.load(f)
     except Exception as e:
         logger.error(f"Failed to load stats: {e}")
-        return {"messages": {}, "global": {}}
+        return
+
+    now = time.time()
+    with _db:
+        _db.execute("BEGIN")
+        # Порядок ключей в JSON = порядок регистрации → сохраняем его в created_at
+        for i, (key, msg) in enumerate(data.get("messages", {}).items()):
+            chat_id, message_id = (int(part) for part in key.split(":"))
+            _db.execute(
+                "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, message_id, msg.get("url", ""), msg.get("username"), msg.get("platform"), now - 1 + i * 1e-6),
+            )
+            _db.executemany(
+                "INSERT OR REPLACE INTO reactions VALUES (?, ?, ?, ?)",
+                [(chat_id, message_id, emoji, count) for emoji, count in msg.get("reactions", {}).items()],
+            )
+        _db.executemany(
+            "INSERT OR REPLACE INTO global_reactions VALUES (?, ?)",
+            list(data.get("global", {}).items()),
+        )
+        for name, value in data.get("config", {}).items():
+            _db.execute("INSERT OR REPLACE INTO config VALUES (?, ?)", (name, json.dumps(value)))
+
+    os.replace(STATS_FILE, STATS_FILE + ".migrated")
+    logger.info("stats.json перенесён в %s (%d сообщений)", STATS_DB, len(data.get("messages", {})))
 
-def save_stats(data: Dict[str, Any]):
-    try:
-        with open(STATS_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Failed to save stats: {e}")
 
 async def register_message(chat_id: int, message_id: int, url: str, username: str, platform: str):
     """Регистрируем отправленное сообщение чтобы отслеживать реакции"""
-    data = load_stats()
-    key = f"{chat_id}:{message_id}"
-    
-    data["messages"][key] = {
+    _load()
+    key = (chat_id, message_id)
+    if _messages.pop(key, None) is not None:
+        _rank_message(key, 0)
+    _messages[key] = {
         "url": url,
         "username": username,
         "platform": platform,
-        "reactions": {}
+        "created_at": time.time(),
+        "reactions": {},
     }
-    
-    # Ограничиваем размер (чистим старые если > 1000)
-    if len(data["messages"]) > 1000:
-        # Удаляем 100 старых
-        keys = list(data["messages"].keys())[:100]
-        for k in keys:
-            del data["messages"][k]
-            
-    save_stats(data)
+    _dirty_messages.add(key)
+    _removed_messages.discard(key)
+
+    # Ограничиваем размер (чистим старые если > MAX_MESSAGES)
+    while len(_messages) > MAX_MESSAGES:
+        old_key, _ = _messages.popitem(last=False)
+        _rank_message(old_key, 0)
+        _dirty_messages.discard(old_key)
+        _removed_messages.add(old_key)
+
+    rollups.record(chat_id, platform, username, posts=1)
+    _mark_dirty()
+
 
 async def handle_reaction(event: MessageReactionUpdated):
-    """Обработка добавления/удаления реакций"""
-    data = load_stats()
-    key = f"{event.chat.id}:{event.message_id}"
-    
-    if key not in data["messages"]:
+    """Обработка добавления/удаления реакций (только в памяти, в базу – пачкой)"""
+    _load()
+    key = (event.chat.id, event.message_id)
+    msg_data = _messages.get(key)
+    if msg_data is None:
         return
 
-    msg_data = data["messages"][key]
-    
     # Считаем новые реакции
     added_emojis = {r.emoji for r in event.new_reaction if hasattr(r, 'emoji')}
     removed_emojis = {r.emoji for r in event.old_reaction if hasattr(r, 'emoji')}
-    
-    # Update message specific stats
-    for emoji in added_emojis:
-        if emoji not in removed_emojis:
-            msg_data["reactions"][emoji] = msg_data["reactions"].get(emoji, 0) + 1
-            data["global"][emoji] = data["global"].get(emoji, 0) + 1
-            
-    for emoji in removed_emojis:
-        if emoji not in added_emojis:
-            current = msg_data["reactions"].get(emoji, 0)
-            if current > 0:
-                msg_data["reactions"][emoji] = current - 1
-                
-            global_cur = data["global"].get(emoji, 0)
-            if global_cur > 0:
-                data["global"][emoji] = global_cur - 1
-
-    save_stats(data)
-
-def get_stats_report() -> str:
-    data = load_stats()
-    global_stats = data.get("global", {})
-    
-    if not global_stats:
+    if added_emojis == removed_emojis:
+        return
+
+    reactions = msg_data["reactions"]
+    net = 0
+    for emoji in added_emojis - removed_emojis:
+        net += 1
+        reactions[emoji] = reactions.get(emoji, 0) + 1
+        _global[emoji] = _global.get(emoji, 0) + 1
+        top_emojis.set(emoji, _global[emoji])
+        _dirty_global.add(emoji)
+
+    for emoji in removed_emojis - added_emojis:
+        if reactions.get(emoji, 0) > 0:
+            reactions[emoji] -= 1
+            net -= 1
+        if _global.get(emoji, 0) > 0:
+            _global[emoji] -= 1
+            top_emojis.set(emoji, _global[emoji])
+            _dirty_global.add(emoji)
+
+    _rank_message(key, sum(reactions.values()))
+    rollups.record(key[0], msg_data["platform"], msg_data["username"], reactions=net)
+    _dirty_messages.add(key)
+    _mark_dirty()
+
+
+def get_stats_report(chat_id: Optional[int] = None, k: int = STATS_TOP_K) -> str:
+    """Отчёт: глобальные счётчики эмодзи + топ-k видео (всех чатов или одного чата)."""
+    _load()
+    if not top_emojis:
         return "📊 Статистика пуста"
-    
-    # Sort by count desc
-    sorted_stats = sorted(global_stats.items(), key=lambda x: x[1], reverse=True)
-    
+
     text = "📊 <b>Статистика реакций:</b>\n\n"
-    for emoji, count in sorted_stats:
+    for emoji, count in top_emojis.top(len(top_emojis)):
         text += f"{emoji}: {count}\n"
-        
-    # Top 3 most reacted messages
-    text += "\n🏆 <b>Топ-3 видео:</b>\n"
-    
-    # Calculate sum of reactions per message
-    msg_stats = []
-    for key, val in data["messages"].items():
-        total = sum(val.get("reactions", {}).values())
-        if total > 0:
-            msg_stats.append((total, val))
-            
-    msg_stats.sort(key=lambda x: x[0], reverse=True)
-    
-    for i, (count, val) in enumerate(msg_stats[:3], 1):
-        top_emojis = sorted(val.get("reactions", {}).items(), key=lambda x: x[1], reverse=True)[:3]
-        emoji_str = " ".join([e[0] for e in top_emojis])
+
+    # Top k most reacted messages
+    board = top_messages if chat_id is None else chat_top_messages.get(chat_id, Leaderboard())
+    where = "" if chat_id is None else " в этом чате"
+    text += f"\n🏆 <b>Топ-{k} видео{where}:</b>\n"
+
+    for i, (key, count) in enumerate(board.top(k), 1):
+        val = _messages[key]
+        top_emojis_msg = sorted(val["reactions"].items(), key=lambda x: x[1], reverse=True)[:3]
+        emoji_str = " ".join([e[0] for e in top_emojis_msg if e[1] > 0])
         text += f"{i}. <a href='{val['url']}'>Видео</a> ({count} {emoji_str})\n"
-        
+
     return text
 
+def get_window_report(title: str, seconds: float, chat_id: Optional[int] = None) -> str:
+    """Отчёт за последние seconds секунд по почасовым/дневным сводкам."""
+    _load()
+    return rollups.get_window_report(title, seconds, chat_id, top=STATS_TOP_K)
+
 def set_report_chat_id(chat_id: int):
-    data = load_stats()
-    if "config" not in data:
-        data["config"] = {}
-    data["config"]["report_chat_id"] = chat_id
-    save_stats(data)
+    _load()
+    _config["report_chat_id"] = chat_id
+    get_db().execute("INSERT OR REPLACE INTO config VALUES ('report_chat_id', ?)", (json.dumps(chat_id),))
 
 def get_report_chat_id() -> int:
-    data = load_stats()
-    return data.get("config", {}).get("report_chat_id")
-
+    _load()
+    return _config.get("report_chat_id")
@@ -2,17 +2,20 @@ import asyncio
 import html
 import logging
 import os
-from typing import List
+import time
+from typing import Dict, List, Optional, Tuple, Union
 
-from aiogram.exceptions import TelegramEntityTooLarge
-from aiogram.types import FSInputFile, InputMediaPhoto
+from aiogram.exceptions import TelegramBadRequest, TelegramEntityTooLarge
+from aiogram.types import FSInputFile, InputMediaPhoto, Message
 
 from bot import bot
-from downloaders import download_video
-from utils import add_to_log, processing_tasks, safe_delete_message, safe_send_message
-
-from utils import add_to_log, processing_tasks, safe_delete_message, safe_send_message
+from utils import CaptionWindow, add_to_log, canonical_url, delete_later, merge_caption, safe_send_message
+import media_cache
+import metrics
+import rate_limiter
+import singleflight
 import stats
+import tracing
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +23,148 @@ logger = logging.getLogger(__name__)
 MediaGroup = List[InputMediaPhoto]
 
 
+EMOJI_MAP = {'TikTok': '🎪', 'Instagram': '📸', 'Youtube': '📺'}
+SENT_LOG_ACTIONS = {'image': 'PHOTO', 'slideshow': 'SLIDESHOW', 'video': 'VIDEO'}
+
+
+def build_caption(file_platform: str, username: str, url: str, user_caption: str = "") -> Tuple[str, str]:
+    """Подпись к медиа (HTML) и эмодзи платформы."""
+    emoji = EMOJI_MAP.get(file_platform, '🎥')
+    caption = f"{emoji} <b><i>{username}</i></b> <a href='{url}'>link</a>"
+    if user_caption:
+        caption += f"\n\n<b>{html.escape(user_caption)}</b>"
+    return caption, emoji
+
+
+def message_file_id(message: Optional[Message]) -> Optional[str]:
+    """file_id медиа из отправленного сообщения."""
+    if message is None:
+        return None
+    if message.photo:
+        return message.photo[-1].file_id
+    for attr in ('video', 'animation', 'audio', 'document'):
+        media = getattr(message, attr, None)
+        if media:
+            return media.file_id
+    return None
+
+
+async def send_media(
+    chat_id: int,
+    media_type: str,
+    media: Union[str, Dict],
+    caption: str,
+    emoji: str,
+    cached: bool = False,
+) -> Tuple[Optional[Message], Union[str, Dict, None]]:
+    """
+    Отправка медиа: пути к файлам или (cached=True) Telegram file_id.
+
+    Returns:
+        Первое отправленное сообщение (для статистики) и file_id
+        в той же форме, что и media (для кэша)
+    """
+    def as_input(value: str):
+        return value if cached else FSInputFile(value)
+
+    if media_type == 'image':
+        sent_msg = await bot.send_photo(chat_id, as_input(media), caption=caption, parse_mode="HTML")
+        return sent_msg, message_file_id(sent_msg)
+
+    if media_type == 'slideshow':
+        # media is dict {'images': [], 'audio': ''}
+        media_group: MediaGroup = []
+        for idx, image in enumerate(media['images']):
+            if idx == 0:
+                media_group.append(InputMediaPhoto(media=as_input(image), caption=caption, parse_mode="HTML"))
+            else:
+                media_group.append(InputMediaPhoto(media=as_input(image)))
+
+        sent_msg = None
+        image_ids: List[str] = []
+        if media_group:
+            msgs = await bot.send_media_group(chat_id, media_group)
+            if msgs:
+                sent_msg = msgs[0]  # Register first message of album
+                image_ids = [message_file_id(m) for m in msgs if message_file_id(m)]
+
+        audio_id = None
+        audio = media.get('audio')
+        if audio and (cached or os.path.exists(audio)):
+            try:
+                audio_msg = await bot.send_audio(chat_id, as_input(audio), caption=f"🎵 {emoji}")
+                audio_id = message_file_id(audio_msg)
+            except TelegramBadRequest as e:
+                # Альбом уже в чате: повторная загрузка прислала бы его второй раз
+                if not cached or sent_msg is None:
+                    raise
+                logger.warning("Кэшированное аудио слайдшоу отклонено: %s", e)
+
+        if len(image_ids) != len(media_group):
+            return sent_msg, None  # не кэшируем неполный альбом
+        return sent_msg, {'images': image_ids, 'audio': audio_id}
+
+    sent_msg = await bot.send_video(chat_id, as_input(media), caption=caption, parse_mode="HTML")
+    return sent_msg, message_file_id(sent_msg)
+
+
+def media_size(media: Union[str, Dict]) -> int:
+    """Размер отправляемых файлов в байтах (для слайдшоу – картинки + аудио)."""
+    paths = [media] if isinstance(media, str) else [*media.get('images', []), media.get('audio')]
+    return sum(os.path.getsize(p) for p in paths if p and os.path.exists(p))
+
+
+async def send_from_cache(chat_id: int, url: str, username: str, platform: str, user_caption: str = "") -> Optional[Message]:
+    """Отправка по кэшированным file_id. None → кэша нет или он устарел."""
+    cached = media_cache.get(url)
+    if not cached:
+        return None
+
+    caption, emoji = build_caption(cached['platform'], username, url, user_caption)
+    try:
+        sent_msg, file_ids = await send_media(chat_id, cached['media_type'], cached['media'], caption, emoji, cached=True)
+    except TelegramBadRequest as e:
+        # Telegram больше не принимает file_id → качаем заново
+        media_cache.invalidate(url)
+        await add_to_log("CACHE", "STALE file_id", error=str(e)[:50])
+        return None
+
+    if cached['media_type'] == 'slideshow' and cached['media'].get('audio') and not (file_ids or {}).get('audio'):
+        # Альбом ушёл, аудио – нет: не шлём альбом заново, а забываем запись до следующей загрузки
+        media_cache.invalidate(url)
+        await add_to_log("CACHE", "STALE audio file_id")
+
+    await add_to_log("CACHE", "SENT by file_id")
+    if sent_msg:
+        await stats.register_message(chat_id, sent_msg.message_id, url, username, platform)
+    return sent_msg
+
+
+async def attach_late_caption(
+    chat_id: int,
+    sent_msg: Optional[Message],
+    caption_window: Optional[CaptionWindow],
+    file_platform: str,
+    username: str,
+    url: str,
+    user_caption: str,
+) -> None:
+    """Текст пришёл уже после отправки медиа → дописываем его в подпись."""
+    if not sent_msg or not caption_window:
+        return
+    if not caption_window.is_open and not caption_window.text:
+        return
+    # Окно уже закрыто, но текст успел прийти до отправки → wait() заберёт его сразу
+    extra = await caption_window.wait()
+    if not extra:
+        return
+    caption, _ = build_caption(file_platform, username, url, merge_caption(user_caption, extra))
+    try:
+        await bot.edit_message_caption(chat_id=chat_id, message_id=sent_msg.message_id, caption=caption, parse_mode="HTML")
+    except Exception as e:
+        logger.warning("Не удалось дописать подпись: %s", e)
+
+
 async def process_video_task(
     message_id: int,
     chat_id: int,
@@ -28,17 +173,50 @@ async def process_video_task(
     username: str,
     platform: str,
     user_caption: str = "",
+    caption_window: Optional[CaptionWindow] = None,
 ) -> None:
-    """Фоновая задача: скачать видео и отправить его пользователю."""
-    task_id = f"{chat_id}_{hash(url)}"
-    if task_id in processing_tasks:
-        await safe_delete_message(chat_id, processing_msg_id)
-        return
-    processing_tasks.add(task_id)
+    """
+    Фоновая задача: скачать видео и отправить его пользователю.
+    Загрузка стартует сразу; текст из caption_window добавляется в подпись при отправке.
+    """
+    task_id = f"{chat_id}_{processing_msg_id}"  # у каждой ссылки своё «⏳» сообщение → id задачи
+    # Контекст задачи: его видят все вложенные вызовы, фоновые задачи и потоки yt-dlp
+    trace = tracing.start_job(task_id, chat_id, username, platform, url, canonical_url(url))
+    acquired = False
+    job_start = time.perf_counter()
+    result = "error"
+
+    async def show_progress(status: str) -> None:
+        """Прогресс сжатия/очереди — в сообщение «⏳ обработка»."""
+        # Лимит чата почти исчерпан → пропускаем: следующий статус всё равно придёт
+        if not rate_limiter.has_spare(chat_id):
+            return
+        try:
+            await bot.edit_message_text(f"⏳ {username}, {platform}... {status}", chat_id=chat_id, message_id=processing_msg_id)
+        except Exception:
+            pass
 
     try:
+        # ⚡ Эту ссылку уже отправляли → шлём по file_id, без скачивания
+        if caption_window:
+            user_caption = merge_caption(user_caption, caption_window.take())
+        with tracing.span("cache"):
+            cached_msg = await send_from_cache(chat_id, url, username, platform, user_caption)
+        if cached_msg:
+            cached = media_cache.get(url)
+            asyncio.create_task(attach_late_caption(
+                chat_id, cached_msg, caption_window, cached['platform'] if cached else platform,
+                username, url, user_caption,
+            ))
+            delete_later(chat_id, processing_msg_id, message_id)
+            result = "cache"
+            return
+
         logger.info("Начинаем загрузку: %s для @%s", url[:50], username)
-        file_path, file_platform, media_type = await download_video(url, platform, username)
+        acquired = True
+        # Присоединившийся к чужой загрузке видит здесь только ожидание: этапы – в трассе первого
+        with tracing.span("fetch"):
+            file_path, file_platform, media_type = await singleflight.acquire(url, platform, on_progress=show_progress)
         logger.info("Загрузка завершена: %s, тип: %s", file_path, media_type)
         
         # Проверяем, что файл существует
@@ -58,66 +236,26 @@ async def process_video_task(
         # Slideshow size check skipped for now or sum up
 
         
-        emoji_map = {'TikTok': '🎪', 'Instagram': '📸', 'Youtube': '📺'}
-        emoji = emoji_map.get(file_platform, '🎥')
-        
-        # Construct final caption
-        base_caption = f"{emoji} <b><i>{username}</i></b> <a href='{url}'>link</a>"
-        if user_caption:
-            base_caption += f"\n\n<b>{html.escape(user_caption)}</b>"
+        if caption_window:
+            user_caption = merge_caption(user_caption, caption_window.take())
+        caption, emoji = build_caption(file_platform, username, url, user_caption)
 
         try:
-            sent_msg = None
-            if media_type == 'image':
-                logger.info("Отправляем фото: %s", file_path)
-                sent_msg = await bot.send_photo(chat_id, FSInputFile(file_path), caption=base_caption, parse_mode="HTML")
-                await add_to_log(
-
-                    url, "PHOTO", "SENT",
-                    username=username, platform=platform
-                )
-            elif media_type == 'slideshow':
-                # file_path is dict {'images': [], 'audio': ''}
-                logger.info("Отправляем слайдшоу: %s", file_path)
-                data = file_path
-                images = data['images']
-                audio = data['audio']
-                
-                # Создаем медиагруппу
-                media_group = []
-                for idx, img_path in enumerate(images):
-                    if idx == 0:
-                        media = InputMediaPhoto(media=FSInputFile(img_path), caption=base_caption, parse_mode="HTML")
-                    else:
-                        media = InputMediaPhoto(media=FSInputFile(img_path))
-                    media_group.append(media)
-                
-                # Отправляем альбом
-                if media_group:
-                   msgs = await bot.send_media_group(chat_id, media_group)
-                   if msgs:
-                       sent_msg = msgs[0] # Register first message of album
-                
-                # Отправляем аудио
-                if audio and os.path.exists(audio):
-                    await bot.send_audio(chat_id, FSInputFile(audio), caption=f"🎵 {emoji}")
-
-                await add_to_log(
-                    url, "SLIDESHOW", "SENT",
-                    username=username, platform=platform
-                )
-
-            else:
-                logger.info("Отправляем видео: %s", file_path)
-                sent_msg = await bot.send_video(chat_id, FSInputFile(file_path), caption=base_caption, parse_mode="HTML")
-                await add_to_log(
-                    url, "VIDEO", "SENT",
-                    username=username, platform=platform
-                )
+            logger.info("Отправляем %s: %s", media_type, file_path)
+            with metrics.timer("stage_seconds", stage="upload", platform=platform):
+                sent_msg, file_ids = await send_media(chat_id, media_type, file_path, caption, emoji)
+            metrics.inc("uploaded_bytes_total", media_size(file_path), platform=platform)
+            result = "sent"
+            await add_to_log(SENT_LOG_ACTIONS.get(media_type, "VIDEO"), "SENT")
+            if file_ids:
+                media_cache.put(url, media_type, file_ids, file_platform)
             
             # 📊 REGISTER STATS
             if sent_msg:
                 await stats.register_message(chat_id, sent_msg.message_id, url, username, platform)
+            asyncio.create_task(attach_late_caption(
+                chat_id, sent_msg, caption_window, file_platform, username, url, user_caption,
+            ))
                 
             logger.info("Медиа успешно отправлено")
         except TelegramEntityTooLarge as e:
@@ -132,61 +270,24 @@ async def process_video_task(
                 f"Лимит: 50MB\n"
                 f"Ссылка: {url}"
             )
-            await add_to_log(
-                url, "TELEGRAM_TOO_LARGE", error_msg,
-                error=str(e), username=username, platform=platform
-            )
+            await add_to_log("TELEGRAM_TOO_LARGE", error_msg, error=str(e))
             # Удаляем временные сообщения
-            await safe_delete_message(chat_id, processing_msg_id)
-            await asyncio.sleep(0.5)
-            await safe_delete_message(chat_id, message_id)
-            # Удаляем файл с задержкой (файл может быть ещё открыт)
-            if os.path.exists(file_path):
-                await asyncio.sleep(1)  # Даём время закрыть файл
-                try:
-                    os.remove(file_path)
-                    logger.info("Файл удален после ошибки Telegram: %s", file_path)
-                except Exception as rm_error:
-                    logger.error("Ошибка при удалении файла: %s", rm_error)
-                    # Пробуем ещё раз через секунду
-                    await asyncio.sleep(1)
-                    try:
-                        os.remove(file_path)
-                        logger.info("Файл удален со второй попытки: %s", file_path)
-                    except Exception:
-                        pass
+            delete_later(chat_id, processing_msg_id, message_id)
+            result = "too_large"
             return  # Не пробрасываем исключение дальше, чтобы не дублировать сообщения
         except Exception as send_error:
             logger.error("Ошибка при отправке медиа: %s", send_error, exc_info=True)
             raise
 
         logger.info("Удаляем временные сообщения")
-        await safe_delete_message(chat_id, processing_msg_id)
-        await asyncio.sleep(0.5)
-        await safe_delete_message(chat_id, message_id)
-        
-        if isinstance(file_path, str) and os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info("Временный файл удален: %s", file_path)
-        elif isinstance(file_path, dict):
-            # Cleanup slideshow
-            for img in file_path.get('images', []):
-                if os.path.exists(img):
-                    os.remove(img)
-            if file_path.get('audio') and os.path.exists(file_path['audio']):
-                os.remove(file_path['audio'])
-            logger.info("Временные файлы слайдшоу удалены")
+        delete_later(chat_id, processing_msg_id, message_id)
 
     except Exception as e:
         logger.error("Ошибка в process_video_task: %s", e, exc_info=True)
-        await safe_delete_message(chat_id, processing_msg_id)
         error_text = str(e)
         
         # Логируем ошибку
-        await add_to_log(
-            url, "ERROR", error_text[:50],
-            error=error_text, username=username, platform=platform
-        )
+        await add_to_log("ERROR", error_text[:50], error=error_text)
         
         # Проверяем, не было ли уже отправлено сообщение (например, для TelegramEntityTooLarge)
         if "Entity Too Large" in error_text or "TELEGRAM_TOO_LARGE" in error_text:
@@ -209,26 +310,12 @@ async def process_video_task(
             await safe_send_message(chat_id, f"❌ @{username}\n{platform} ошибка\n{error_text[:150]}\nСсылка: {url}")
         
         # Удаляем временные сообщения
-        await safe_delete_message(chat_id, processing_msg_id)
-        await asyncio.sleep(0.5)
-        await safe_delete_message(chat_id, message_id)
-        
-        # Удаляем файл с задержкой
-        if 'file_path' in locals() and os.path.exists(file_path):
-            await asyncio.sleep(1)  # Даём время закрыть файл
-            try:
-                os.remove(file_path)
-                logger.info("Файл удален после ошибки: %s", file_path)
-            except Exception as rm_error:
-                logger.error("Ошибка при удалении файла: %s", rm_error)
-                # Пробуем ещё раз через секунду
-                await asyncio.sleep(1)
-                try:
-                    os.remove(file_path)
-                    logger.info("Файл удален со второй попытки: %s", file_path)
-                except Exception:
-                    pass
+        delete_later(chat_id, processing_msg_id, message_id)
     finally:
-        if task_id in processing_tasks:
-            processing_tasks.remove(task_id)
+        # Временные файлы удаляет последний чат, получивший эту загрузку
+        if acquired:
+            await singleflight.release(url, on_progress=show_progress)
+        metrics.observe("job_seconds", time.perf_counter() - job_start, platform=platform, result=result)
+        metrics.inc("jobs_total", platform=platform, result=result)
+        tracing.finish_job(trace)
 
@@ -0,0 +1,151 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
+
+# Сколько последних трасс держим для /trace
+TRACE_KEEP = 100
+# Не больше стольких спанов/событий в одной трассе (зацикленные ретраи не раздувают память)
+MAX_SPANS = 500
+
+
+class Span:
+    __slots__ = ("name", "parent", "start", "end", "attrs")
+
+    def __init__(self, name: str, parent: Optional["Span"], attrs: Dict[str, str]):
+        self.name = name
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.attrs = attrs
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+
+class Trace:
+    """
+    Контекст одной задачи (job id, чат, пользователь, платформа, ссылка как прислали
+    и каноническая) и её спаны. Живёт в ContextVar: его наследует всё, что задача ждёт, создаёт
+    через create_task и отправляет в пул потоков с copy_context.
+    """
+
+    __slots__ = (
+        "job_id", "chat_id", "username", "platform", "url", "canonical_url", "started_at", "root", "spans", "events",
+    )
+
+    def __init__(self, job_id: str, chat_id: int, username: str, platform: str, url: str, canonical_url: str):
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.username = username
+        self.platform = platform
+        self.url = url  # ключ лога загрузки (add_to_log без url)
+        self.canonical_url = canonical_url
+        self.started_at = time.time()
+        self.root = Span("job", None, {})
+        self.spans: List[Span] = [self.root]
+        self.events: List[tuple] = []  # (время, спан, текст) – записи add_to_log внутри задачи
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+recent_traces: "OrderedDict[str, Trace]" = OrderedDict()
+
+
+def current() -> Optional[Trace]:
+    return current_trace.get()
+
+
+def start_job(job_id: str, chat_id: int, username: str, platform: str, url: str, canonical_url: str) -> Trace:
+    """Начать трассу задачи в текущем контексте (вызывается из process_video_task)."""
+    trace = Trace(job_id, chat_id, username, platform, url, canonical_url)
+    current_trace.set(trace)
+    current_span.set(trace.root)
+    recent_traces[job_id] = trace
+    while len(recent_traces) > TRACE_KEEP:
+        recent_traces.popitem(last=False)
+    return trace
+
+
+def finish_job(trace: Trace) -> None:
+    trace.root.end = time.perf_counter()
+
+
+@contextmanager
+def span(name: str, **attrs: str) -> Iterator[Optional[Span]]:
+    """Замер участка внутри текущей задачи; без трассы – ничего не делает."""
+    trace = current_trace.get()
+    if trace is None or len(trace.spans) >= MAX_SPANS:
+        yield None
+        return
+    item = Span(name, current_span.get(), attrs)
+    trace.spans.append(item)
+    token = current_span.set(item)
+    try:
+        yield item
+    finally:
+        item.end = time.perf_counter()
+        current_span.reset(token)
+
+
+def event(text: str) -> None:
+    """Отметка в трассе текущей задачи (записи лога загрузки)."""
+    trace = current_trace.get()
+    if trace is not None and len(trace.events) < MAX_SPANS:
+        trace.events.append((time.perf_counter(), current_span.get(), text))
+
+
+def _depth(item: Optional[Span]) -> int:
+    depth = 0
+    while item is not None and item.parent is not None:
+        depth += 1
+        item = item.parent
+    return depth
+
+
+def _span_label(item: Span) -> str:
+    attrs = " ".join(value for value in item.attrs.values() if value)
+    return f"{item.name} [{attrs}]" if attrs else item.name
+
+
+def format_trace(trace: Trace) -> str:
+    """Дерево спанов со смещением от старта и длительностью, события лога – между ними."""
+    origin = trace.root.start
+    lines = [
+        f"🧵 {trace.job_id} | {trace.platform} | @{trace.username} | {trace.canonical_url}",
+        f"⏱ всего {trace.root.duration:.2f}s",
+    ]
+    rows = [(item.start, 0, item) for item in trace.spans[1:]]
+    rows += [(ts, 1, (owner, text)) for ts, owner, text in trace.events]
+    for ts, kind, item in sorted(rows, key=lambda row: (row[0], row[1])):
+        if kind == 0:
+            indent = "  " * _depth(item)
+            lines.append(f"{indent}+{ts - origin:.2f}s {_span_label(item)} {item.duration:.2f}s")
+        else:
+            owner, text = item
+            lines.append(f"{'  ' * (_depth(owner) + 1)}+{ts - origin:.2f}s · {text}")
+    return "\n".join(lines)
+
+
+def export_folded(trace: Trace) -> str:
+    """
+    Трасса в «свёрнутых стеках» (job;fetch;download 1234 – собственное время в мс)
+    для flamegraph.pl / speedscope.
+    """
+    own: Dict[int, float] = {id(item): item.duration for item in trace.spans}
+    for item in trace.spans:
+        if item.parent is not None:
+            own[id(item.parent)] -= item.duration
+
+    lines = []
+    for item in trace.spans:
+        path = []
+        node: Optional[Span] = item
+        while node is not None:
+            path.append(_span_label(node).replace(";", ","))
+            node = node.parent
+        lines.append(f"{';'.join(reversed(path))} {max(0, round(own[id(item)] * 1000))}")
+    return "\n".join(lines)
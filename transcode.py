@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+import metrics
+from config import FFMPEG_PROGRESS_INTERVAL, FFMPEG_TIMEOUT, FFMPEG_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# Куда сообщать о прогрессе кодирования (ставится на время одной загрузки в singleflight).
+# Слушатель синхронный и не ждёт Telegram: чтение pipe ffmpeg не должно стоять из-за правок
+progress_listener: ContextVar[Optional[Callable[[str], None]]] = ContextVar(
+    "progress_listener", default=None
+)
+
+_slots: Optional[asyncio.Semaphore] = None
+queued = 0   # задач ждут свободного слота
+running = 0  # ffmpeg-процессов работает сейчас
+
+metrics.register_gauge("ffmpeg_running", "FFmpeg работает", lambda: running)
+metrics.register_gauge("ffmpeg_queued", "FFmpeg в очереди", lambda: queued)
+
+
+def _get_slots() -> asyncio.Semaphore:
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(FFMPEG_WORKERS)
+    return _slots
+
+
+def _report(status: str) -> None:
+    listener = progress_listener.get()
+    if listener is None:
+        return
+    try:
+        listener(status)
+    except Exception as e:
+        logger.debug("Progress listener failed: %s", e)
+
+
+async def probe(path: str) -> Dict[str, Any]:
+    """ffprobe: формат и потоки файла ({} если не удалось)."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        stdout, _ = await proc.communicate()
+        if proc.returncode != 0:
+            return {}
+        return json.loads(stdout or b"{}")
+    except Exception as e:
+        logger.warning("ffprobe failed for %s: %s", path, e)
+        return {}
+
+
+async def probe_duration(path: str) -> Optional[float]:
+    """Длительность файла в секундах (или None)."""
+    info = await probe(path)
+    try:
+        return float(info["format"]["duration"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+async def run_ffmpeg(
+    args: List[str],
+    timeout: float = FFMPEG_TIMEOUT,
+    duration: Optional[float] = None,
+    label: str = "FFmpeg",
+    timings: Optional[List[float]] = None,
+) -> bool:
+    """
+    Запуск ffmpeg (аргументы без самого 'ffmpeg') в общем пуле.
+
+    Не больше FFMPEG_WORKERS процессов одновременно, остальные ждут в очереди.
+    Процесс асинхронный — event loop не блокируется. По таймауту или отмене задачи
+    процесс убивается. Если известна duration, прогресс уходит в progress_listener.
+    timeout и время в timings (если передан список) считаются с момента, когда
+    получен слот, – ожидание в очереди в них не входит.
+    """
+    global queued, running
+    slots = _get_slots()
+    if slots.locked():
+        _report(f"🎬 {label}: в очереди ({queued + 1})")
+    queued += 1
+    try:
+        await slots.acquire()
+    finally:
+        queued -= 1
+
+    running += 1
+    started = time.monotonic()
+    try:
+        return await asyncio.wait_for(_execute(args, duration, label), timeout)
+    except asyncio.TimeoutError:
+        logger.error("%s timeout (%.0fs): %s", label, timeout, " ".join(args[:8]))
+        return False
+    finally:
+        running -= 1
+        slots.release()
+        if timings is not None:
+            timings.append(time.monotonic() - started)
+
+
+async def _execute(args: List[str], duration: Optional[float], label: str) -> bool:
+    cmd = ['ffmpeg', '-hide_banner', '-nostats', '-progress', 'pipe:1', *args]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    stderr_tail: deque = deque(maxlen=10)
+
+    async def read_stderr() -> None:
+        async for raw in proc.stderr:
+            stderr_tail.append(raw.decode(errors="replace").rstrip())
+
+    stderr_task = asyncio.create_task(read_stderr())
+    last_report = 0.0
+    try:
+        _report(f"🎬 {label}...")
+        async for raw in proc.stdout:
+            key, _, value = raw.decode(errors="replace").strip().partition("=")
+            if key != "out_time_us" or not duration:
+                continue
+            now = time.monotonic()
+            if now - last_report < FFMPEG_PROGRESS_INTERVAL:
+                continue
+            last_report = now
+            try:
+                percent = min(99, int(int(value) / 1_000_000 / duration * 100))
+            except ValueError:
+                continue
+            _report(f"🎬 {label}: {percent}%")
+        await proc.wait()
+        await stderr_task
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        stderr_task.cancel()
+
+    if proc.returncode != 0:
+        logger.warning("%s exit %s: %s", label, proc.returncode, " | ".join(list(stderr_tail)[-3:]))
+        return False
+    return True
@@ -1,41 +1,34 @@
+import asyncio
 import logging
 import re
 import time
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Set
+from typing import Dict, Optional, Set
+from urllib.parse import parse_qs, urlsplit
 
 from bot import bot
+from config import DELETE_BATCH_WINDOW, LOG_ENTRIES_PER_URL, LOG_MAX_URLS
+from log_store import DownloadLog, LogEntry
+import history
+import tracing
 
-from contextlib import contextmanager
-import asyncio
-
-@contextmanager
-def username_context(username: str):
-    """Context manager для логирования с username (пустышка если нет в utils)"""
-    old_username = getattr(username_context, 'current_username', None)
-    username_context.current_username = username
-    
-    try:
-        yield username
-    finally:
-        username_context.current_username = old_username
+logger = logging.getLogger(__name__)
 
+# Лимит Bot API на один deleteMessages
+DELETE_BATCH_SIZE = 100
 
-logger = logging.getLogger(__name__)
+# Лог по ссылкам: LRU на LOG_MAX_URLS ссылок, у каждой – последние LOG_ENTRIES_PER_URL записей
+download_log = DownloadLog(LOG_MAX_URLS, LOG_ENTRIES_PER_URL)
 
-# Структура: {url: [{"timestamp": str, "action": str, "status": str, "username": str, 
-#                    "api": str, "platform": str, "duration": float, "error": str}, ...]}
-download_log: Dict[str, List[Dict[str, Any]]] = {}
-processing_tasks: Set[str] = set()
-# Храним время начала для каждого URL (сбрасывается при новом запросе)
-download_start_times: Dict[str, float] = {}
+# Удаления, ждущие пакетной отправки: {chat_id: {message_id, ...}}
+pending_deletes: Dict[int, Set[int]] = {}
+_delete_flushers: Dict[int, asyncio.Task] = {}
 
 
 async def add_to_log(
-    url: str,
     action: str,
     status: str = "",
     error: str = "",
+    url: Optional[str] = None,
     username: Optional[str] = None,
     api: Optional[str] = None,
     platform: Optional[str] = None,
@@ -44,42 +37,52 @@ async def add_to_log(
     """
     Добавление записи в лог загрузки по конкретному URL.
     
+    Внутри задачи ссылка, пользователь и платформа берутся из трассы (tracing),
+    передавать их нужно только вне задачи или чтобы переопределить.
+    
     Args:
-        url: URL загружаемого контента
         action: Действие (например, "TikTok API 1", "Instagram HTML")
         status: Статус выполнения
         error: Текст ошибки (если есть)
+        url: URL загружаемого контента
         username: Имя пользователя, который запросил загрузку
         api: Использованное API (например, "tikwm.com", "GraphQL")
         platform: Платформа (tiktok, instagram, youtube)
         duration: Время выполнения в секундах
     """
-    timestamp = datetime.now().strftime("%H:%M:%S")
+    trace = tracing.current()
+    if trace is not None:
+        url = url or trace.url
+        username = username or trace.username
+        platform = platform or trace.platform
     safe_action = str(action).replace('*', '').replace('_', '').replace('`', '')
     safe_status = str(status or error or '⏳').replace('*', '').replace('_', '').replace('`', '')
     
+    if not url:
+        # Вне задачи и без ссылки – записи некуда относиться, только в общий лог
+        logger.info(f"📝 [{safe_action}] {safe_status}")
+        return
+    
     # Если это начало загрузки, сбрасываем и запоминаем время
     if "START" in action.upper():
-        download_start_times[url] = time.time()
+        download_log.start(url)
     
     # Вычисляем длительность если не передана и есть время начала
-    if duration is None and url in download_start_times:
-        duration = time.time() - download_start_times[url]
+    if duration is None:
+        duration = download_log.elapsed(url)
     
-    log_entry = {
-        "timestamp": timestamp,
-        "action": safe_action,
-        "status": safe_status,
-        "username": username or "system",
-        "api": api or "",
-        "platform": platform or "",
-        "duration": round(duration, 2) if duration else None,
-        "error": error or "",
-    }
-
-    if url not in download_log:
-        download_log[url] = []
-    download_log[url].append(log_entry)
+    log_entry = LogEntry(
+        action=safe_action,
+        status=safe_status,
+        username=username or "system",
+        api=api or "",
+        platform=platform or "",
+        duration=round(duration, 2) if duration else None,
+        error=error or "",
+    )
+    download_log.append(url, log_entry)
+    history.record(canonical_url(url), log_entry)
+    tracing.event(f"{safe_action}: {safe_status}" + (f" ({api})" if api else ""))
     
     # Формируем строку для logger
     log_str = f"📝 [{safe_action}] {url[:50]}: {safe_status}"
@@ -92,6 +95,61 @@ async def add_to_log(
     logger.info(log_str)
 
 
+def canonical_url(url: str) -> str:
+    """
+    Каноническая форма ссылки (ключ для кэшей): без www/m., трекинговых
+    параметров, якоря и завершающего слэша. Для YouTube сохраняется id видео.
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parts.path.rstrip('/')
+
+    if host == "youtu.be":
+        return f"https://youtube.com/watch?v={path.lstrip('/')}"
+    if host == "youtube.com" and path == "/watch":
+        video_id = parse_qs(parts.query).get("v", [""])[0]
+        return f"https://youtube.com/watch?v={video_id}"
+    return f"https://{host}{path}"
+
+
+def merge_caption(caption: str, extra: str) -> str:
+    """Склеиваем подпись из ссылки и подпись, пришедшую отдельным сообщением."""
+    if caption and extra:
+        return f"{caption}\n{extra}"
+    return caption or extra
+
+
+class CaptionWindow:
+    """
+    Окно после ссылки, в которое может прийти подпись отдельным сообщением
+    (сценарий «ссылка, потом текст»). Загрузка при этом уже идёт.
+    """
+
+    def __init__(self, seconds: float):
+        self.deadline = time.time() + seconds
+        self.text = ""
+
+    @property
+    def is_open(self) -> bool:
+        return time.time() < self.deadline
+
+    def add(self, text: str) -> None:
+        self.text = merge_caption(self.text, text)
+
+    def take(self) -> str:
+        """Забрать то, что уже пришло (не ждём)."""
+        text, self.text = self.text, ""
+        return text
+
+    async def wait(self) -> str:
+        """Дождаться закрытия окна и забрать то, что пришло."""
+        await asyncio.sleep(max(0.0, self.deadline - time.time()))
+        return self.take()
+
+
 async def safe_delete_message(chat_id: int, message_id: int):
     """Безопасное удаление сообщения (игнорирует любые ошибки Telegram)."""
     try:
@@ -100,6 +158,45 @@ async def safe_delete_message(chat_id: int, message_id: int):
         pass
 
 
+def delete_later(chat_id: int, *message_ids: int) -> None:
+    """
+    Поставить сообщения в очередь на удаление. Через DELETE_BATCH_WINDOW
+    все накопленные сообщения чата удаляются одним deleteMessages.
+    """
+    pending_deletes.setdefault(chat_id, set()).update(message_ids)
+    if chat_id not in _delete_flushers:
+        _delete_flushers[chat_id] = asyncio.create_task(_flush_later(chat_id))
+
+
+async def _flush_later(chat_id: int) -> None:
+    try:
+        await asyncio.sleep(DELETE_BATCH_WINDOW)
+    finally:
+        _delete_flushers.pop(chat_id, None)
+        await flush_deletes(chat_id)
+
+
+async def flush_deletes(chat_id: int) -> None:
+    """Удалить накопленные сообщения чата пачками по 100; при ошибке – по одному."""
+    message_ids = sorted(pending_deletes.pop(chat_id, ()))
+    for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        batch = message_ids[start:start + DELETE_BATCH_SIZE]
+        try:
+            await bot.delete_messages(chat_id, batch)
+        except Exception as e:
+            logger.debug("deleteMessages в чате %s не прошёл (%s), удаляем по одному", chat_id, e)
+            for message_id in batch:
+                await safe_delete_message(chat_id, message_id)
+
+
+async def flush_all_deletes() -> None:
+    """При остановке бота: удалить всё, что ещё ждёт в очереди."""
+    for task in list(_delete_flushers.values()):
+        task.cancel()
+    for chat_id in list(pending_deletes):
+        await flush_deletes(chat_id)
+
+
 async def safe_send_message(chat_id: int, text: str, parse_mode=None) -> None:
     """Безопасная отправка без Markdown-ошибок."""
     try:
@@ -115,32 +212,32 @@ async def safe_send_message(chat_id: int, text: str, parse_mode=None) -> None:
         await bot.send_message(chat_id, clean_text[:4000])
 
 
-def format_log_entry(entry: Dict[str, Any]) -> str:
+def format_log_entry(entry: LogEntry) -> str:
     """
     Форматирование одной записи лога для отображения.
     
     Args:
-        entry: Словарь с данными записи лога
+        entry: Запись лога
         
     Returns:
         Отформатированная строка
     """
-    parts = [f"[{entry['timestamp']}] {entry['action']}: {entry['status']}"]
+    parts = [f"[{entry.timestamp}] {entry.action}: {entry.status}"]
     
-    if entry.get('username') and entry['username'] != 'system':
-        parts.append(f"👤 @{entry['username']}")
+    if entry.username and entry.username != 'system':
+        parts.append(f"👤 @{entry.username}")
     
-    if entry.get('api'):
-        parts.append(f"🔌 API: {entry['api'][:40]}")
+    if entry.api:
+        parts.append(f"🔌 API: {entry.api[:40]}")
     
-    if entry.get('platform'):
-        parts.append(f"📱 {entry['platform'].upper()}")
+    if entry.platform:
+        parts.append(f"📱 {entry.platform.upper()}")
     
-    if entry.get('duration'):
-        parts.append(f"⏱ {entry['duration']}s")
+    if entry.duration:
+        parts.append(f"⏱ {entry.duration}s")
     
-    if entry.get('error'):
-        parts.append(f"❌ {entry['error'][:50]}")
+    if entry.error:
+        parts.append(f"❌ {entry.error[:50]}")
     
     return " | ".join(parts)
 
@@ -0,0 +1,212 @@
+import asyncio
+import contextvars
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import yt_dlp
+
+from config import YTDLP_BACKEND, YTDLP_INFO_CACHE_SIZE, YTDLP_INFO_TTL, YTDLP_WORKERS
+from utils import canonical_url
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# {canonical_url: (время извлечения, info)} — OrderedDict как LRU
+_info_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+# Свой пул для yt-dlp (не общий executor asyncio.to_thread)
+_executor: Optional[Executor] = None
+pending_jobs = 0  # отправлено в пул и ещё не завершено
+
+
+# Сколько YoutubeDL (по наборам опций) держит один воркер
+YDL_CACHE_SIZE = 4
+
+# YoutubeDL на поток/процесс воркера: в пределах одного потока экземпляр не делится
+_local = threading.local()
+
+
+class YtdlpError(Exception):
+    """
+    Ошибка yt-dlp из воркера. Исключения yt-dlp ссылаются на _YDLLogger и не переживают
+    pickle – из процесса вместо DownloadError пришёл бы PicklingError. Здесь только текст.
+    """
+
+
+def _get_ydl(opts: Dict[str, Any]) -> yt_dlp.YoutubeDL:
+    """YoutubeDL воркера для этих опций: загруженные экстракторы переиспользуются между ссылками."""
+    cache: "OrderedDict[str, yt_dlp.YoutubeDL]" = getattr(_local, "ydls", None)
+    if cache is None:
+        cache = _local.ydls = OrderedDict()
+    key = json.dumps(opts, sort_keys=True, default=str)
+    ydl = cache.get(key)
+    if ydl is None:
+        ydl = cache[key] = yt_dlp.YoutubeDL(opts)
+        while len(cache) > YDL_CACHE_SIZE:
+            cache.popitem(last=False)[1].close()
+    else:
+        cache.move_to_end(key)
+    return ydl
+
+
+def _warm_worker() -> None:
+    """Инициализация процесса-воркера: YoutubeDL с загруженными экстракторами – до первой ссылки."""
+    ydl = _get_ydl({'quiet': True})
+    for name in ('TikTok', 'Instagram', 'Youtube'):
+        try:
+            ydl.get_info_extractor(name)
+        except Exception:
+            pass
+
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if YTDLP_BACKEND == "process":
+            _executor = ProcessPoolExecutor(
+                max_workers=YTDLP_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_worker,
+            )
+        else:
+            _executor = ThreadPoolExecutor(max_workers=YTDLP_WORKERS, thread_name_prefix="yt-dlp")
+    return _executor
+
+
+metrics.register_gauge("ytdlp_pending_jobs", "Задач в пуле yt-dlp", lambda: pending_jobs)
+
+
+def queue_stats() -> Dict[str, Any]:
+    """Загрузка пула yt-dlp: сколько работает и сколько ждёт."""
+    return {
+        "backend": YTDLP_BACKEND,
+        "workers": YTDLP_WORKERS,
+        "running": min(pending_jobs, YTDLP_WORKERS),
+        "queued": max(0, pending_jobs - YTDLP_WORKERS),
+    }
+
+
+def _traced(func: Callable, *args: Any) -> Any:
+    """Работа в потоке пула: спан открывается, когда воркер взял задачу, а не при постановке в очередь."""
+    with tracing.span("worker", source=func.__name__.strip("_")):
+        return func(*args)
+
+
+async def _run(func: Callable, *args: Any) -> Any:
+    global pending_jobs
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    pending_jobs += 1
+    try:
+        # При отмене задачи ещё не начатая работа снимается с очереди пула.
+        # В поток уходит копия контекста (трасса задачи); в процесс контекст не передаётся
+        if isinstance(executor, ThreadPoolExecutor):
+            return await loop.run_in_executor(executor, contextvars.copy_context().run, _traced, func, *args)
+        return await loop.run_in_executor(executor, func, *args)
+    finally:
+        pending_jobs -= 1
+
+
+async def startup() -> None:
+    """Поднимаем воркеры заранее (в режиме process — прогреваем все процессы)."""
+    executor = _get_executor()
+    if isinstance(executor, ProcessPoolExecutor):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, time.sleep, 0.1) for _ in range(YTDLP_WORKERS)))
+    logger.info("🎞 yt-dlp pool started: %s × %d", YTDLP_BACKEND, YTDLP_WORKERS)
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _extract(url: str, opts: Dict[str, Any]) -> Dict[str, Any]:
+    ydl = _get_ydl({'quiet': True, **opts})
+    try:
+        info = ydl.extract_info(url, download=False)
+        # JSON-совместимая копия — как у --load-info-json, её можно обрабатывать повторно
+        return ydl.sanitize_info(info)
+    except Exception as e:
+        raise YtdlpError(str(e)) from None
+
+
+def _download(info: Dict[str, Any], opts: Dict[str, Any], cancelled: Optional[threading.Event] = None) -> str:
+    opts = {'quiet': True, **opts}
+    if cancelled is not None:
+        def check_cancelled(_status: Dict[str, Any]) -> None:
+            if cancelled.is_set():
+                raise yt_dlp.utils.DownloadCancelled("job abandoned")
+        opts['progress_hooks'] = [*opts.get('progress_hooks', []), check_cancelled]
+
+    # Свой YoutubeDL на каждое скачивание: в опциях – progress hook этой задачи
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+            downloads = result.get('requested_downloads') or []
+            if downloads and downloads[-1].get('filepath'):
+                return downloads[-1]['filepath']
+            return ydl.prepare_filename(result)
+    except Exception as e:
+        raise YtdlpError(str(e)) from None
+
+
+async def extract_info(url: str, opts: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    extract_info(download=False) с коротким кэшем по канонической ссылке.
+
+    Один и тот же info используется для выбора формата, скачивания видео
+    и скачивания аудио — страница разбирается один раз.
+    """
+    key = canonical_url(url)
+    cached = _info_cache.get(key)
+    if cached and time.time() - cached[0] < YTDLP_INFO_TTL:
+        _info_cache.move_to_end(key)
+        return cached[1]
+
+    with metrics.timer("stage_seconds", stage="resolve", source="yt-dlp"):
+        info = await _run(_extract, url, opts or {})
+    _info_cache[key] = (time.time(), info)
+    _info_cache.move_to_end(key)
+    while len(_info_cache) > YTDLP_INFO_CACHE_SIZE:
+        _info_cache.popitem(last=False)
+    return info
+
+
+@metrics.timed("stage_seconds", stage="download", source="yt-dlp")
+async def download(url: str, opts: Dict[str, Any]) -> str:
+    """Скачивание по уже извлечённому info (process_ie_result). Возвращает путь к файлу."""
+    # Формат и имя файла выбираются при скачивании, извлечению они не нужны
+    extract_opts = {k: v for k, v in opts.items() if k not in ('format', 'outtmpl')}
+    info = await extract_info(url, extract_opts)
+    # В потоке уже идущую загрузку можно прервать через progress hook;
+    # в процессе — только снять с очереди (Event между процессами не передаём)
+    cancelled = threading.Event() if YTDLP_BACKEND != "process" else None
+    try:
+        path = await _run(_download, info, opts, cancelled)
+    except asyncio.CancelledError:
+        if cancelled is not None:
+            cancelled.set()
+        raise
+    except Exception:
+        # Ссылки на CDN в info могли протухнуть — в следующий раз извлекаем заново
+        invalidate(url)
+        raise
+    if os.path.exists(path):
+        metrics.inc("downloaded_bytes_total", os.path.getsize(path), source="yt-dlp")
+    return path
+
+
+def invalidate(url: str) -> None:
+    _info_cache.pop(canonical_url(url), None)